@@ -4,15 +4,7 @@
 from google.appengine.ext import vendor
 vendor.add('lib')
 
-###
-# Setup Flickr API
-###
-import flickr_api # NOQA
-from photoamaze import config # NOQA
-flickr_api.set_keys(api_key=config.Flickr.api_key,
-                    api_secret=config.Flickr.api_secret)
-flickr_api.enable_cache()
-
+# Note: The Flickr API is set up on first use in photoamaze.auth.
 
 ###
 # Setup app stats.
@@ -0,0 +1,175 @@
+"""
+    admission
+    =========
+
+    Admission control for image requests. Each maze and each client IP gets a
+    concurrency limit and a token bucket, so one busy maze or client cannot
+    take all request threads and fetch capacity from everyone else. Requests
+    over a limit are shed right away.
+
+    The state is kept in-process. The app runs on a single instance, so that
+    is the whole picture, and checking it costs no RPCs.
+
+    :copyright: 2017 David Volquartz Lebech
+    :license: MIT, see LICENSE for details
+
+"""
+import json
+import threading
+import time
+from collections import Counter
+
+import webapp2
+
+from photoamaze.config import Admission
+
+# Scope of image requests that do not belong to a maze or a public search.
+PUBLIC_SCOPE = 'public'
+
+_lock = threading.Lock()
+
+# (kind, name) -> requests in flight.
+_in_flight = Counter()
+
+# (kind, name) -> (tokens, last refill time).
+_buckets = {}
+
+# Metrics since the instance started.
+_admitted = Counter()
+_shed = Counter()
+_shed_scopes = Counter()
+_shed_clients = Counter()
+
+
+class Ticket(object):
+    """The outcome of an admission check. Admitted tickets hold a slot until
+    they are released, which happens when used as a context manager.
+
+    """
+    def __init__(self, scope, client, admitted, reason=None, retry_after=0):
+        self.scope = scope
+        self.client = client
+        self.admitted = admitted
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def release(self):
+        if self.admitted:
+            self.admitted = False
+            with _lock:
+                _release(('maze', self.scope))
+                _release(('ip', self.client))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _release(key):
+    _in_flight[key] -= 1
+    if _in_flight[key] <= 0:
+        del _in_flight[key]
+
+
+def _tokens(key, rate, burst, now):
+    """Returns the refilled tokens of a bucket."""
+    tokens, last = _buckets.get(key, (burst, now))
+    return min(burst, tokens + (now - last) * rate)
+
+
+def _count(counter, key):
+    """Counts a key, keeping only the most common keys when there are too
+    many."""
+    counter[key] += 1
+    if len(counter) > Admission.max_buckets:
+        common = counter.most_common(Admission.max_buckets // 2)
+        counter.clear()
+        counter.update(dict(common))
+
+
+def _prune(now):
+    """Forgets idle buckets, so clients that went away do not use memory."""
+    idle = [key for key, (tokens, last) in _buckets.items()
+            if now - last > Admission.bucket_idle_time]
+    for key in idle:
+        del _buckets[key]
+
+
+def search_scope(search):
+    """Returns the scope of the image requests of a public maze, given the
+    search digest of its image urls. Every search gets its own limits, like a
+    maze does.
+
+    """
+    if search and len(search) <= 40 and search.isalnum():
+        return '{}:{}'.format(PUBLIC_SCOPE, search)
+    return PUBLIC_SCOPE
+
+
+def admit(scope, client):
+    """Checks whether a request for the given scope, usually a maze ID, from
+    the given client IP can be served. Returns a :class:`Ticket`.
+
+    """
+    scope = scope or PUBLIC_SCOPE
+    maze_key, ip_key = ('maze', scope), ('ip', client)
+    now = time.time()
+
+    with _lock:
+        reason, retry_after = None, 0
+        if _in_flight[maze_key] >= Admission.maze_concurrency:
+            reason, retry_after = 'maze-concurrency', 1
+        elif _in_flight[ip_key] >= Admission.ip_concurrency:
+            reason, retry_after = 'ip-concurrency', 1
+        else:
+            maze_tokens = _tokens(maze_key, Admission.maze_rate,
+                                  Admission.maze_burst, now)
+            ip_tokens = _tokens(ip_key, Admission.ip_rate,
+                                Admission.ip_burst, now)
+            if maze_tokens < 1:
+                reason = 'maze-rate'
+                retry_after = (1 - maze_tokens) / Admission.maze_rate
+            elif ip_tokens < 1:
+                reason = 'ip-rate'
+                retry_after = (1 - ip_tokens) / Admission.ip_rate
+            else:
+                # Only take tokens when the request is admitted.
+                if len(_buckets) >= Admission.max_buckets:
+                    _prune(now)
+                _buckets[maze_key] = (maze_tokens - 1, now)
+                _buckets[ip_key] = (ip_tokens - 1, now)
+                _in_flight[maze_key] += 1
+                _in_flight[ip_key] += 1
+                _count(_admitted, scope)
+                return Ticket(scope, client, True)
+
+        _shed[reason] += 1
+        _count(_shed_scopes, scope)
+        _count(_shed_clients, client)
+
+    # Retry-After is in whole seconds.
+    return Ticket(scope, client, False, reason=reason,
+                  retry_after=max(1, int(retry_after + 0.999)))
+
+
+def metrics(top=20):
+    """Returns the admission metrics of this instance."""
+    with _lock:
+        return {
+            'admitted': sum(_admitted.values()),
+            'admitted_mazes': _admitted.most_common(top),
+            'shed': dict(_shed),
+            'shed_mazes': _shed_scopes.most_common(top),
+            'shed_clients': _shed_clients.most_common(top),
+            'in_flight': [(kind, name, count) for (kind, name), count
+                          in _in_flight.most_common(top)],
+        }
+
+
+class AdmissionMetricsHandler(webapp2.RequestHandler):
+    """Shows who is being shed by the admission control."""
+    def get(self, *args, **kwargs):
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(metrics()))
@@ -12,14 +12,28 @@ import json
 import urllib
 import urlparse
 import logging
+import threading
 
-import flickr_api
-from flickr_api.flickrerrors import FlickrAPIError
-from instagram import InstagramAPI, InstagramAPIError
 from google.appengine.api import urlfetch
 from google.appengine.ext import ndb
 
 from photoamaze import config
+from photoamaze.util import LazyModule
+
+
+def _setup_flickr(flickr_api):
+    flickr_api.set_keys(api_key=config.Flickr.api_key,
+                        api_secret=config.Flickr.api_secret)
+    flickr_api.enable_cache()
+
+
+# The provider SDKs are slow to import, so they are only imported when used.
+flickr_api = LazyModule('flickr_api', setup=_setup_flickr)
+instagram = LazyModule('instagram')
+
+# Flickr auth handlers by access token.
+_FLICKR_AUTH = {}
+_FLICKR_AUTH_LOCK = threading.Lock()
 
 
 class FacebookAuthError(Exception):
@@ -83,39 +97,70 @@ class FacebookAuth(object):
 
 
 def init_instagram(access_token=None, redirect_url=None):
-    return InstagramAPI(client_id=config.Instagram.client_id,
-                        client_secret=config.Instagram.client_secret,
-                        access_token=access_token,
-                        redirect_uri=redirect_url)
+    return instagram.InstagramAPI(client_id=config.Instagram.client_id,
+                                  client_secret=config.Instagram.client_secret,
+                                  access_token=access_token,
+                                  redirect_uri=redirect_url)
 
 
 def init_flickr_auth(access_token_key, access_token_secret):
-    return flickr_api.auth.AuthHandler(
-        access_token_key=str(access_token_key),
-        access_token_secret=str(access_token_secret))
+    """Returns an auth handler for the given access token. Auth handlers are
+    reused for the same token."""
+    token = (str(access_token_key), str(access_token_secret))
+    a = _FLICKR_AUTH.get(token)
+    if not a:
+        a = flickr_api.auth.AuthHandler(access_token_key=token[0],
+                                        access_token_secret=token[1])
+        with _FLICKR_AUTH_LOCK:
+            if len(_FLICKR_AUTH) >= 1000:
+                _FLICKR_AUTH.clear()
+            _FLICKR_AUTH[token] = a
+    return a
 
 
 @ndb.tasklet
 def check_flickr_user_for_maze(maze):
+    """Finds the Flickr user linked to the maze, without asking Flickr. The user
+    ID (NSID) is the ID of the user access, so a revoked token is only noticed
+    when the user is used, see :func:`handle_flickr_error`.
+
+    """
     user = None
     if maze.flickr.user_access:
         user_access = yield maze.flickr.user_access.get_async()
         if user_access:
-            try:
-                a = init_flickr_auth(user_access.access_token,
-                                     user_access.access_token_secret)
-                user = flickr_api.Person.getFromToken(token=a)
-                user.setToken(token=a)
-            except FlickrAPIError as e:
-                logging.exception(e)
-                # If status 98, token has probably been revoked so we should
-                # delete the link.
-                if e.code == 98:
-                    maze.flickr.user_access = None
-                    yield user_access.key.delete_async(), maze.put_async()
+            a = init_flickr_auth(user_access.access_token,
+                                 user_access.access_token_secret)
+            user = flickr_api.Person(id=user_access.key.id())
+            user.setToken(token=a)
     raise ndb.Return(user)
 
 
+def handle_flickr_error(maze, error):
+    """Handles an error from a Flickr call made with the maze's Flickr user."""
+    logging.exception(error)
+    # If status 98, token has probably been revoked so we should delete the
+    # link.
+    from flickr_api.flickrerrors import FlickrAPIError
+    if (isinstance(error, FlickrAPIError) and error.code == 98 and
+            maze.flickr and maze.flickr.user_access):
+        user_access_key = maze.flickr.user_access
+        maze.flickr.user_access = None
+        future = user_access_key.delete_async()
+        _unlink_flickr(maze.key, user_access_key)
+        future.get_result()
+
+
+@ndb.transactional
+def _unlink_flickr(maze_key, user_access_key):
+    """Unlinks a Flickr user from a fresh copy of the maze. The copy of the
+    caller may be old, and putting it would undo changes made since."""
+    maze = maze_key.get()
+    if maze and maze.flickr and maze.flickr.user_access == user_access_key:
+        maze.flickr.user_access = None
+        maze.put()
+
+
 @ndb.tasklet
 def check_instagram_user_for_maze(maze):
     user = None
@@ -125,7 +170,7 @@ def check_instagram_user_for_maze(maze):
             try:
                 api = init_instagram(access_token=user_access.access_token)
                 user = api.user(user_access.key.id())
-            except InstagramAPIError as e:
+            except instagram.InstagramAPIError as e:
                 logging.exception(e)
                 # If status 400, token has probably been revoked so we
                 # should delete the link.
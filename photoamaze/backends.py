@@ -0,0 +1,234 @@
+"""
+    backends
+    ========
+
+    Cache, fetch and image backends. The App Engine services are used by
+    default. Setting ``PHOTOAMAZE_BACKEND=local`` swaps in a cache shared by
+    the worker processes through a SQLite file, a stdlib HTTP fetcher,
+    Pillow-based resizing and blobs streamed by the WSGI server. Everything
+    else, like entities, tasks and the blobstore, still needs the App Engine
+    APIs.
+
+    :copyright: 2017 David Volquartz Lebech
+    :license: MIT, see LICENSE for details
+
+"""
+import contextlib
+import cPickle as pickle
+import random
+import sqlite3
+import threading
+import time
+import urllib2
+
+from photoamaze import config
+from photoamaze.util import ThreadResult
+
+
+class SharedCache(object):
+    """Cache with the parts of the memcache API used by Photo Amaze, kept in a
+    SQLite file so every worker process on the machine shares it, including
+    cache generation bumps. Values are pickled like in memcache, so callers
+    can modify what they get back.
+
+    """
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS cache '
+            '(key BLOB PRIMARY KEY, expires REAL, value BLOB)')
+
+    def _connection(self):
+        # SQLite connections cannot be shared between threads. Transactions
+        # are handled by _transaction.
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self._path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _get(self, db, key):
+        row = db.execute('SELECT expires, value FROM cache WHERE key = ?',
+                         (_key(key),)).fetchone()
+        if row and row[0] and row[0] < time.time():
+            return None
+        return row
+
+    def _put(self, db, key, expires, value):
+        db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                   (_key(key), expires,
+                    buffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))))
+        # Expired entries are cleaned up now and then.
+        if random.random() < 0.001:
+            db.execute('DELETE FROM cache WHERE expires > 0 AND expires < ?',
+                       (time.time(),))
+
+    def get(self, key):
+        row = self._get(self._connection(), key)
+        return pickle.loads(str(row[1])) if row else None
+
+    def set(self, key, value, time=0):
+        with self._transaction() as db:
+            self._put(db, key, _expiry(time), value)
+        return True
+
+    def add(self, key, value, time=0):
+        with self._transaction() as db:
+            if self._get(db, key):
+                return False
+            self._put(db, key, _expiry(time), value)
+        return True
+
+    def delete(self, key):
+        return self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        with self._transaction() as db:
+            db.executemany('DELETE FROM cache WHERE key = ?',
+                           [(_key(key),) for key in keys])
+        return True
+
+    def incr(self, key, delta=1, initial_value=None):
+        with self._transaction() as db:
+            row = self._get(db, key)
+            if row:
+                expires, value = row[0], pickle.loads(str(row[1]))
+            elif initial_value is not None:
+                expires, value = 0, initial_value
+            else:
+                return None
+            value += delta
+            self._put(db, key, expires, value)
+        return value
+
+
+def _key(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return buffer(key)
+
+
+def _expiry(seconds):
+    return time.time() + seconds if seconds else 0
+
+
+class FetchResult(object):
+    def __init__(self, status_code, content, content_type):
+        self.status_code = status_code
+        self.content = content
+        self.content_type = content_type
+
+
+def _appengine_fetch(url):
+    from google.appengine.api import urlfetch
+    resp = urlfetch.fetch(url, validate_certificate=True)
+    return FetchResult(resp.status_code, resp.content,
+                       resp.headers.get('content-type'))
+
+
+def _local_fetch(url):
+    try:
+        resp = urllib2.urlopen(url, timeout=10)
+    except urllib2.HTTPError as e:
+        return FetchResult(e.code, e.read(), e.headers.get('content-type'))
+    return FetchResult(resp.getcode(), resp.read(),
+                       resp.info().get('content-type'))
+
+
+def _appengine_resize_async(data, size, correct_orientation=False):
+    from google.appengine.api import images
+    orientation = (images.CORRECT_ORIENTATION if correct_orientation
+                   else images.UNCHANGED_ORIENTATION)
+    return images.resize_async(data,
+                               width=size,
+                               height=size,
+                               output_encoding=images.JPEG,
+                               correct_orientation=orientation)
+
+
+# EXIF orientation -> PIL transpose operations.
+_ORIENTATIONS = {
+    2: ('FLIP_LEFT_RIGHT',),
+    3: ('ROTATE_180',),
+    4: ('FLIP_TOP_BOTTOM',),
+    5: ('FLIP_LEFT_RIGHT', 'ROTATE_90'),
+    6: ('ROTATE_270',),
+    7: ('FLIP_LEFT_RIGHT', 'ROTATE_270'),
+    8: ('ROTATE_90',),
+}
+
+
+def _pillow_resize(data, size, correct_orientation):
+    from cStringIO import StringIO
+    from PIL import Image
+
+    img = Image.open(StringIO(data))
+    if correct_orientation:
+        exif = img._getexif() if hasattr(img, '_getexif') else None
+        orientation = (exif or {}).get(0x0112)
+        for op in _ORIENTATIONS.get(orientation, ()):
+            img = img.transpose(getattr(Image, op))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.thumbnail((size, size), Image.ANTIALIAS)
+    out = StringIO()
+    # Metadata is not carried over, like with the App Engine images service.
+    img.save(out, 'JPEG', quality=85)
+    return out.getvalue()
+
+
+def _local_resize_async(data, size, correct_orientation=False):
+    return ThreadResult(_pillow_resize, data, size, correct_orientation)
+
+
+def _appengine_send_blob(request, response, blob_info):
+    # App Engine streams the blob after the handler returns, like
+    # blobstore_handlers.BlobstoreDownloadHandler.send_blob.
+    from google.appengine.ext import blobstore
+    response.headers[blobstore.BLOB_KEY_HEADER] = str(blob_info.key())
+    response.content_type = blob_info.content_type
+
+
+# Block size for streaming blobs.
+_BLOB_BLOCK_SIZE = 512 * 1024
+
+
+def _local_send_blob(request, response, blob_info):
+    # The blob is read in blocks while the response is written. Servers with a
+    # wsgi.file_wrapper get to stream it their own way.
+    from google.appengine.ext import blobstore
+    reader = blobstore.BlobReader(blob_info.key(),
+                                  buffer_size=_BLOB_BLOCK_SIZE)
+    wrapper = request.environ.get('wsgi.file_wrapper')
+    if wrapper:
+        response.app_iter = wrapper(reader, _BLOB_BLOCK_SIZE)
+    else:
+        response.app_iter = iter(lambda: reader.read(_BLOB_BLOCK_SIZE), '')
+    response.content_type = blob_info.content_type
+    response.content_length = blob_info.size
+
+
+if config.BACKEND == 'local':
+    cache = SharedCache(config.LOCAL_CACHE_PATH)
+    fetch = _local_fetch
+    resize_async = _local_resize_async
+    send_blob = _local_send_blob
+else:
+    from google.appengine.api import memcache
+    cache = memcache
+    fetch = _appengine_fetch
+    resize_async = _appengine_resize_async
+    send_blob = _appengine_send_blob
@@ -9,6 +9,7 @@
 
 """
 import os
+import tempfile
 import jinja2
 import webapp2
 
@@ -16,9 +17,74 @@ from util import ReadOnly
 
 
 DEBUG = os.environ.get('SERVER_SOFTWARE', 'Google').startswith('Dev')
+VERSION = os.environ.get('CURRENT_VERSION_ID', '')
+BACKEND = os.environ.get('PHOTOAMAZE_BACKEND', 'appengine')
+# The cache file of the local backend, shared by all worker processes.
+LOCAL_CACHE_PATH = os.environ.get(
+    'PHOTOAMAZE_CACHE', os.path.join(tempfile.gettempdir(),
+                                     'photoamaze-cache.sqlite3'))
 PEPPER = os.environ.get('AUTH_PEPPER')
 EMAIL = os.environ.get('NO_REPLY_EMAIL')
+TEXTURE_KEY = os.environ.get('TEXTURE_KEY') or os.environ.get('SESSION_KEY')
 MEMCACHE_TIME = 600 if not DEBUG else 1
+PAGE_CACHE_TIME = 3600 if not DEBUG else 1
+
+# Responses smaller than this are not compressed.
+COMPRESS_MIN_SIZE = 1024
+
+# Textures can be composited on the server, with the letterbox and caption
+# drawn in, so clients do not have to draw them. Needs PIL. Captions are drawn
+# with TEXTURE_FONT, a TrueType font file, or PIL's default font if not set.
+COMPOSITE_TEXTURES = os.environ.get('COMPOSITE_TEXTURES') == 'yes'
+TEXTURE_FONT = os.environ.get('TEXTURE_FONT')
+
+# Signed texture urls are valid for at least this many seconds. The expiry is
+# rounded so urls stay the same, and cacheable, for the whole period.
+TEXTURE_URL_TIME = 86400
+
+# Mazes are cached in-process for a few seconds. Other instances do not see
+# changes to a maze until their copy expires.
+MAZE_CACHE_TIME = 5 if not DEBUG else 0
+
+# Images that could not be loaded, like deleted photos or failing external
+# urls, are not looked up again for this many seconds.
+MISSING_IMAGE_TIME = 300 if not DEBUG else 1
+
+# Uploaded image contents never change, so they can be cached for long.
+CONTENT_MEMCACHE_TIME = 86400 if not DEBUG else 1
+
+# Supported maze sizes, in rows and columns. Layouts are generated once per
+# seed and size and then cached.
+MAZE_MIN_SIZE = 2
+MAZE_MAX_SIZE = 200
+MAZE_DEFAULT_SIZE = 10
+
+# Walls further than this many cells from the start get low-resolution
+# textures in the image manifest.
+MANIFEST_NEAR_DISTANCE = 3
+
+# Textures of frozen mazes never change, so browsers can keep them for long.
+SNAPSHOT_TEXTURE_TIME = 86400 * 30
+
+# Background ingestion of external images. Mazes viewed within the last
+# INGEST_ACTIVE_DAYS are ingested at most once every INGEST_INTERVAL seconds.
+INGEST_INTERVAL = 900 if not DEBUG else 10
+INGEST_ACTIVE_DAYS = 14
+INDEX_MAX_IMAGES = 500
+
+# Photos mailed to a maze are processed in batches. Mails arriving within
+# MAIL_BATCH_WINDOW seconds are handled together, one mail at a time, until
+# MAIL_BATCH_SIZE mails or MAIL_BATCH_BYTES of mail have been processed.
+MAIL_MAX_SIZE = 30 * 1024 * 1024
+MAIL_BATCH_SIZE = 50
+MAIL_BATCH_BYTES = 64 * 1024 * 1024
+MAIL_BATCH_WINDOW = 10
+
+# Uploaded photos are resized and stored in batches of this size. At most
+# UPLOAD_MAX_IMAGES uploaded photos are shown in a maze.
+UPLOAD_BATCH_SIZE = 10
+UPLOAD_MAX_SIZE = 20 * 1024 * 1024
+UPLOAD_MAX_IMAGES = 1000
 
 # Has to be a dict.
 WEBAPP_CONFIG = {
@@ -34,12 +100,55 @@ class Instagram(ReadOnly):
     client_secret = os.environ.get('INSTAGRAM_CLIENT_SECRET')
     memcache_time = 86400 if not DEBUG else 1
 
+    # Pagination settings. Instagram returns at most 33 media per page and the
+    # total number of images is capped per maze across all Instagram feeds.
+    page_size = 33
+    max_images = int(os.environ.get('INSTAGRAM_MAX_IMAGES', 100))
+
 
 class Flickr(ReadOnly):
     api_key = os.environ.get('FLICKR_API_KEY')
     api_secret = os.environ.get('FLICKR_API_SECRET')
     memcache_time = 86400 if not DEBUG else 1
 
+    # Pagination settings. The total number of images is capped per maze
+    # across all Flickr sources.
+    page_size = 50
+    max_images = int(os.environ.get('FLICKR_MAX_IMAGES', 100))
+
+
+class Admission(ReadOnly):
+    """Limits for image requests, per maze and per client IP. Rates are in
+    requests per second and bursts are the sizes of the token buckets.
+
+    A single viewer requests around 60 textures at once when a maze starts,
+    and more as the walls further away are loaded, so the limits of a client
+    leave room for a few of those bursts and the limits of a maze for many
+    viewers at once.
+
+    """
+    maze_concurrency = 400
+    maze_rate = 500
+    maze_burst = 2000
+    ip_concurrency = 100
+    ip_rate = 60
+    ip_burst = 300
+
+    # Buckets are pruned when there are this many, dropping the ones idle for
+    # longer than bucket_idle_time seconds.
+    max_buckets = 10000
+    bucket_idle_time = 60
+
+
+class Proxy(ReadOnly):
+    """Settings of the texture proxy in :mod:`photoamaze.proxy`."""
+    # External fetches in flight at once and the timeout of each, in seconds.
+    max_clients = 1000
+    fetch_timeout = 10
+
+    # Threads for loading uploaded images.
+    threads = 10
+
 
 class Facebook(ReadOnly):
     app_id = os.environ.get('FACEBOOK_APP_ID')
@@ -55,12 +164,25 @@ class Twitter(ReadOnly):
     share_button = os.environ.get('TWITTER_SHARE_BUTTON') == 'yes'
 
 
-def create_jinja2_env():
-    """Sets up a jinja environment."""
+def create_jinja2_env(cache):
+    """Sets up a jinja environment. Compiled templates are shared between
+    instances through the given cache and templates are only reloaded in
+    debug mode.
+
+    """
     template_path = os.path.abspath(
         os.path.join(os.path.dirname(__file__), '..', 'templates'))
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_path))
+    bytecode_cache = jinja2.MemcachedBytecodeCache(
+        cache, prefix='jinja2:{}:'.format(VERSION))
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_path),
+                             bytecode_cache=bytecode_cache,
+                             auto_reload=DEBUG,
+                             cache_size=-1)
     env.globals.update({'uri_for': webapp2.uri_for})
     return env
 
-JINJA = create_jinja2_env()
+
+def preload_templates(env):
+    """Compiles all templates, so no request has to."""
+    for name in env.list_templates(extensions=['html']):
+        env.get_template(name)
@@ -11,23 +11,32 @@
 import sys
 import json
 import base64
+import hashlib
 import logging
-import mimetypes
 import traceback
 from urllib import quote
 
 import webapp2
-import flickr_api
-from instagram.oauth2 import OAuth2AuthExchangeError
-from webapp2_extras import sessions
-from google.appengine.api import images as gae_images, memcache, urlfetch
-from google.appengine.ext import blobstore, ndb
+from webapp2_extras import security, sessions
+from google.appengine.ext import blobstore, deferred, ndb
 
-from photoamaze import models, util, imageutil, mail, auth, config
-from photoamaze.config import JINJA, MEMCACHE_TIME, Flickr, Instagram
+from photoamaze import (models, util, imageutil, ingest, mail, auth, config,
+                        mazegen, snapshot, admission)
+from photoamaze.auth import flickr_api, instagram
+from photoamaze.backends import cache, fetch, send_blob
+from photoamaze.config import MEMCACHE_TIME, Flickr, Instagram
+
+# The backends import the configuration, so the environment is created here
+# rather than in photoamaze.config.
+JINJA = config.create_jinja2_env(cache)
 
 
 class BaseHandler(webapp2.RequestHandler):
+    # Stateless handlers do not touch the session for mazes without a
+    # password, so their responses have no cookies and can be cached by
+    # shared caches.
+    stateless = False
+
     def head(self, *args, **kwargs):
         """Fall-back method for head request."""
         pass
@@ -47,7 +56,6 @@ class BaseHandler(webapp2.RequestHandler):
         access = self.session.get(access_id)
         if not access:
             access = dict(has_access=False, is_admin=False)
-            self.session[access_id] = access
         return access
 
     def has_access(self, access_id):
@@ -58,10 +66,15 @@ class BaseHandler(webapp2.RequestHandler):
 
     def update_access(self, access_id, **kw):
         access = self.get_access(access_id)
-        access.update(**kw)
+
+        # Only changed sessions are saved, so leave the session alone if
+        # nothing changes.
+        if all(access.get(k) == v for k, v in kw.items()):
+            return
 
         # Always explicitly set the session value to ensure that the session
         # backend knows the value has been updated.
+        access = dict(access, **kw)
         self.session[access_id] = access
 
     def dispatch(self):
@@ -72,13 +85,76 @@ class BaseHandler(webapp2.RequestHandler):
             # Dispatch the request.
             webapp2.RequestHandler.dispatch(self)
         finally:
-            # Save all sessions.
+            # Save all sessions. Only sessions that were loaded and modified
+            # are actually written to the response.
             self.session_store.save_sessions(self.response)
 
     def handle_exception(self, exception, debug, *args, **kwargs):
         handle_http_exception(self.request, self.response, exception)
 
     def prepare_response(self, template_name, **template_vars):
+        body = self.render(template_name, **template_vars).encode('utf-8')
+        self.response.charset = 'utf-8'
+        self.write_compressed(body)
+
+    def negotiate_encoding(self, encodings):
+        """Returns the first of the given encodings that the client accepts, or
+        identity."""
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        accepted = util.accepted_encodings(
+            self.request.headers.get('Accept-Encoding'))
+        for encoding in encodings:
+            if encoding in accepted:
+                return encoding
+        return 'identity'
+
+    def write_compressed(self, body):
+        """Writes the body, compressed if it is large enough and the client
+        accepts it."""
+        if len(body) >= config.COMPRESS_MIN_SIZE:
+            encoding = self.negotiate_encoding(util.ENCODINGS)
+            if encoding != 'identity':
+                self.response.headers['Content-Encoding'] = encoding
+                body = util.compress(body, encoding)
+        self.response.write(body)
+
+    def write_variants(self, variants):
+        """Writes the best of the given precompressed variants, see
+        util.encode_variants."""
+        encoding = self.negotiate_encoding(
+            [e for e in util.ENCODINGS if e in variants])
+        if encoding != 'identity':
+            self.response.headers['Content-Encoding'] = encoding
+        self.response.write(variants[encoding])
+
+    def prepare_cached_response(self, template_name):
+        """Writes a page without per-user state from the rendered-response
+        cache. Requests with a query string are rendered as usual.
+
+        """
+        if self.request.query_string:
+            return self.prepare_response(template_name)
+
+        cache_key = 'page:{}:{}'.format(config.VERSION, template_name)
+        page = cache.get(cache_key)
+        if not page:
+            body = self.render(template_name).encode('utf-8')
+            page = (util.encode_variants(body, config.COMPRESS_MIN_SIZE),
+                    '"{}"'.format(hashlib.sha1(body).hexdigest()))
+            cache.set(cache_key, page, time=config.PAGE_CACHE_TIME)
+
+        variants, etag = page
+        self.response.headers['ETag'] = etag
+        self.response.headers['Cache-Control'] = 'public, max-age={}'.format(
+            config.PAGE_CACHE_TIME)
+        if etag in self.request.headers.get('If-None-Match', ''):
+            self.response.set_status(304)
+            return
+        self.response.content_type = 'text/html'
+        self.response.charset = 'utf-8'
+        self.write_variants(variants)
+
+    def render(self, template_name, **template_vars):
         # Prepare template variables.
         if template_vars is None:
             template_vars = {}
@@ -98,14 +174,13 @@ class BaseHandler(webapp2.RequestHandler):
         # Add configuration
         template_vars.update(config=config)
 
-        # Render the template and write.
-        resp = JINJA.get_template(template_name).render(**template_vars)
-        self.response.write(resp)
+        # Render the template.
+        return JINJA.get_template(template_name).render(**template_vars)
 
 
 class LandingHandler(BaseHandler):
     def get(self):
-        self.prepare_response('landing.html')
+        self.prepare_cached_response('landing.html')
 
     def post(self):
         maze_type = self.request.POST.get('maze-type')
@@ -153,105 +228,160 @@ class LandingHandler(BaseHandler):
 
 class CreditsHandler(BaseHandler):
     def get(self):
-        self.prepare_response('credits.html')
+        self.prepare_cached_response('credits.html')
 
 
 class PrivacyHandler(BaseHandler):
     def get(self):
-        self.prepare_response('privacy.html')
+        self.prepare_cached_response('privacy.html')
 
 
 class TermsHandler(BaseHandler):
     def get(self):
-        self.prepare_response('terms.html')
+        self.prepare_cached_response('terms.html')
 
 
 class ImageHandler(BaseHandler):
+    def dispatch(self):
+        # Image requests go through admission control first, so a single
+        # maze or client cannot take all request threads.
+        ticket = admission.admit(self.admission_scope(),
+                                 self.request.remote_addr)
+        if not ticket.admitted:
+            self.response.set_status(429)
+            self.response.headers['Retry-After'] = str(ticket.retry_after)
+            return
+        with ticket:
+            super(ImageHandler, self).dispatch()
+
+    def admission_scope(self):
+        return self.request.route_kwargs.get('maze_id')
+
     def serve_image(self, image_key):
-        decoded = base64.urlsafe_b64decode(image_key)
-        img_type, img_url_key, size = decoded.split(';')
-        img_ok = False
-
-        if img_type == 'b':  # Blob
-            img_ok = self._serve_blob(img_url_key, size)
-        elif img_type == imageutil.EXTERNAL_FLICKR:
-            img_ok = self._serve_external(img_url_key, Flickr.memcache_time)
-        elif img_type == imageutil.EXTERNAL_INSTAGRAM:
-            img_ok = self._serve_external(img_url_key, Instagram.memcache_time)
-
-        if not img_ok:
+        if self._stream_blob(image_key):
+            return
+        image = self.load_image(image_key)
+        if not image:
             self.abort(404)
+        self.write_image(*image)
 
-    def _serve_external(self, image_url_key, memcache_time):
-        url = base64.b64decode(image_url_key)
-        content = memcache.get(url)
-        content_type = None
+    def _stream_blob(self, image_key):
+        """Streams images that are still stored as blobstore blobs straight
+        from the blobstore, when the original fits the requested size and is
+        upright. Returns False for all other images, which are normalized and
+        served from their renditions.
 
-        if content is None:
-            resp = urlfetch.fetch(url, validate_certificate=True)
-            content = resp.content
-            content_type = resp.headers.get('content-type', 'image/jpeg')
-            # If the contents are less than 800KB, try and store it in memcache
-            # with a timeout of 24 hours.
-            if len(content) < 800000:
-                try:
-                    memcache.set(url, content, time=memcache_time)
-                except Exception as e:
-                    logging.exception(e)
+        """
+        if imageutil.is_missing(image_key):
+            return False
+        try:
+            img_type, img_url_key, size = imageutil.decode_image_key(
+                image_key)
+        except (TypeError, ValueError):
+            return False
+        if img_type != 'b':
+            return False
+
+        blob_info = imageutil.streamable_blob(img_url_key, size)
+        if not blob_info:
+            return False
+        send_blob(self.request, self.response, blob_info)
+        self.response.headers['Cache-Control'] = 'public, max-age=36000'
+        self.response.headers['Pragma'] = 'Public'
+        return True
 
-        if content_type is None:
-            guess = mimetypes.guess_type(url)
-            if guess[0] is not None:
-                content_type = guess[0]
-            else:
-                content_type = 'image/jpeg'
+    def serve_composite(self, image_key, caption):
+        image = self.load_composite(image_key, caption)
+        if not image:
+            self.abort(404)
+        self.write_image(*image)
 
+    def write_image(self, content, content_type, max_age=36000):
         self.response.content_type = content_type
-        self.response.headers['Cache-Control'] = 'public, max-age=36000'
+        self.response.headers['Cache-Control'] = 'public, max-age={}'.format(
+            max_age)
         self.response.headers['Pragma'] = 'Public'
         self.response.write(content)
-        return True
 
-    def _serve_blob(self, image_key, size):
-        maze_image = ndb.Key(urlsafe=image_key).get()
-
-        size = int(size)
-        if size < 0 or size > 1024:
-            size = 1024
-
-        img = None
-
-        if maze_image.image_key:
-            blob_info = blobstore.get(maze_image.image_key)
-            if blob_info:
-                with blob_info.open() as blob_reader:
-                    img = gae_images.resize(
-                        blob_reader.read(),
-                        width=size,
-                        height=size,
-                        output_encoding=gae_images.JPEG,
-                        correct_orientation=gae_images.CORRECT_ORIENTATION)
-        elif maze_image.image:
-            if size == 1024:  # Image should already be 1024.
-                img = maze_image.image
+    def load_composite(self, image_key, caption):
+        """Loads an image as a square power-of-two texture with the caption
+        drawn in, cached per image key, which includes the size, and caption.
+        Returns a tuple like :meth:`load_image`.
+
+        """
+        cache_key = 'composite:{}:{}'.format(
+            hashlib.sha1(image_key).hexdigest(),
+            hashlib.sha1(caption.encode('utf-8')).hexdigest())
+        texture = cache.get(cache_key)
+        if texture is None:
+            image = self.load_image(image_key)
+            if not image:
+                return None
+            try:
+                texture = imageutil.composite_texture(image[0], caption)
+            except IOError as e:
+                # PIL could not read the image, use it as it is.
+                logging.exception(e)
+                return image
+            try:
+                cache.set(cache_key, texture,
+                          time=config.CONTENT_MEMCACHE_TIME)
+            except Exception as e:
+                logging.exception(e)
+        return texture, 'image/jpeg'
+
+    def load_image(self, image_key):
+        """Loads the contents of an encoded image key. Returns a tuple of the
+        contents and content type, or None if there is no such image.
+
+        """
+        if imageutil.is_missing(image_key):
+            return None
+        try:
+            img_type, img_url_key, size = imageutil.decode_image_key(
+                image_key)
+        except (TypeError, ValueError):
+            image = None
+        else:
+            cache_time = imageutil.external_cache_time(img_type)
+            if cache_time is not None:
+                image = self._load_external(img_url_key, cache_time)
             else:
-                img = gae_images.resize(maze_image.image,
-                                        width=size,
-                                        height=size,
-                                        output_encoding=gae_images.JPEG)
-
-        if img:
-            self.response.content_type = 'image/jpeg'
-            self.response.headers['Cache-Control'] = 'public, max-age=36000'
-            self.response.headers['Pragma'] = 'Public'
-            self.response.write(img)
-            return True
+                image = imageutil.load_internal_image(img_type, img_url_key,
+                                                      size)
+        if not image:
+            imageutil.remember_missing(image_key)
+        return image
+
+    def _load_external(self, image_url_key, cache_time):
+        url = imageutil.external_url(image_url_key)
+        content = cache.get(url)
+        content_type = None
 
-        return False
+        if content is None:
+            try:
+                resp = fetch(url)
+            except Exception as e:
+                logging.exception(e)
+                return None
+            if resp.status_code != 200 or not resp.content:
+                logging.warning('Could not fetch {}: {}'.format(
+                    url, resp.status_code))
+                return None
+            content = resp.content
+            content_type = resp.content_type
+            imageutil.cache_external(url, content, cache_time)
+
+        return content, imageutil.external_content_type(url, content_type)
 
 
 class PublicImageHandler(ImageHandler):
+    def admission_scope(self):
+        return admission.search_scope(self.request.GET.get('s'))
+
     def get(self, image_id):
+        if not imageutil.is_external(image_id):
+            self.abort(404)
         self.serve_image(image_id)
 
 
@@ -270,22 +400,41 @@ class PublicMazeHandler(BaseHandler):
 class PublicImageListHandler(BaseHandler):
     """Handler for returning a list of images for a public maze."""
     def get(self, *args, **kwargs):
-        size = int(self.request.GET.get('size', 0))
+        # Every viewport width maps to one of a few image sizes, so the cache
+        # is keyed by that instead of the raw width.
+        size = imageutil.normalize_size(int(self.request.GET.get('size', 0)))
         flickr_tags = self.request.GET.get('ft', '')
         flickr_user = self.request.GET.get('fu', '')
 
-        images = imageutil.flickr_search(flickr_tags,
-                                         flickr_user,
-                                         size=size)
-
-        # Prepare the real urls.
-        for image in images:
-            image.url = self.uri_for(
-                'public-image', image_id=base64.urlsafe_b64encode(image.url))
+        # The rendered list is cached with precompressed variants.
+        search = hashlib.sha1(u'{}|{}'.format(flickr_tags, flickr_user)
+                              .encode('utf-8')).hexdigest()
+        cache_key = 'public:imagelist:{}:{}'.format(size, search)
+        variants = cache.get(cache_key)
+        if not variants:
+            images = imageutil.flickr_search(flickr_tags,
+                                             flickr_user,
+                                             size=size)
+
+            # Prepare the real urls. The search is included so every search
+            # is admitted on its own, see admission.search_scope.
+            for image in images:
+                image.url = self.uri_for(
+                    'public-image',
+                    image_id=base64.urlsafe_b64encode(image.url),
+                    s=search[:12])
+
+            images = [img.to_dict() for img in images]
+            variants = util.encode_variants(json.dumps(images),
+                                            config.COMPRESS_MIN_SIZE)
+            # The search returns nothing when Flickr fails, which should not
+            # stick around.
+            if images:
+                util.cache_variants(cache, cache_key, variants,
+                                    time=MEMCACHE_TIME)
 
-        images = [img.to_dict() for img in images]
         self.response.content_type = 'application/json'
-        self.response.write(json.dumps(images))
+        self.write_variants(variants)
 
 
 class AuthInstagramHandler(BaseHandler):
@@ -320,10 +469,11 @@ class AuthInstagramHandler(BaseHandler):
                         maze.instagram = models.InstagramSettings()
                     maze.instagram.user_access = user_access
                     maze.put()
+                    ingest.enqueue_maze(maze_id, force=True)
                     self.redirect_to(
                         'maze-admin', maze_id=maze_id, admin_key=admin_key,
                         success='Successfully linked your Instagram account')
-                except OAuth2AuthExchangeError as e:
+                except instagram.oauth2.OAuth2AuthExchangeError as e:
                     logging.exception(e)
                     self.abort(400, explanation=e.description)
                 except Exception as e:
@@ -377,6 +527,7 @@ class AuthFlickrHandler(BaseHandler):
                         maze.flickr = models.FlickrSettings()
                     maze.flickr.user_access = user_access
                     maze.put()
+                    ingest.enqueue_maze(maze_id, force=True)
                     self.redirect_to('maze-admin',
                                      maze_id=maze_id,
                                      admin_key=admin_key)
@@ -472,14 +623,15 @@ def maze_required(handler):
 
     """
     def check_maze(self, maze_id, *args, **kwargs):
-        maze = models.Maze.get_by_id(maze_id)
+        maze = models.Maze.get_cached(maze_id)
         if maze:
             self.maze = maze
 
             # If there is a password but the access level is False, redirect to
             # login url. Otherwise, proceed with the handler.
             if not maze.password:
-                self.update_access(maze_id, has_access=True)
+                if not self.stateless:
+                    self.update_access(maze_id, has_access=True)
             elif maze.password and not self.has_access(maze_id):
                 return self.redirect_to('maze-login',
                                         maze_id=maze_id,
@@ -499,7 +651,7 @@ def maze_admin_required(handler):
 
     """
     def check_maze_admin(self, maze_id, admin_key, *args, **kwargs):
-        maze = models.Maze.get_by_id(maze_id)
+        maze = models.Maze.get_cached(maze_id)
         if maze:
             self.maze = maze
 
@@ -527,8 +679,15 @@ def maze_admin_required(handler):
 class MazeHandler(BaseHandler):
     @maze_required
     def get(self, *args, **kwargs):
+        maze_size = mazegen.clamp_size(self.request.GET.get('size'),
+                                       config.MAZE_DEFAULT_SIZE)
+        frozen = (snapshot.get_snapshot(self.maze.snapshot)
+                  if self.maze.snapshot else None)
+        if frozen:
+            maze_size = frozen.size
         self.prepare_response('maze/maze.html',
                               maze_id=self.maze.key.id(),
+                              maze_size=maze_size,
                               name=self.maze.name or 'A Photo Maze',
                               enable_sharing=self.maze.enable_sharing,
                               share_url=quote(self.request.url))
@@ -545,43 +704,63 @@ class MazeAdminHandler(BaseHandler):
         self.prepare_admin_page(maze_id, admin_key, status=status)
 
     def prepare_admin_page(self, maze_id, admin_key, **page_variables):
-        instagram_user = self.prepare_instagram()
-        flickr_user = self.prepare_flickr()
+        # The providers are asked at the same time.
+        instagram_user = util.ThreadResult(self.prepare_instagram)
+        flickr_user = util.ThreadResult(self.prepare_flickr)
         # TODO: Facebook support when approved.
         # facebook_user = self.prepare_facebook()
+        # Uploads go straight to the blobstore, which then calls the upload
+        # handler.
+        upload_url = blobstore.create_upload_url(
+            self.uri_for('maze-admin-upload', maze_id=maze_id,
+                         admin_key=admin_key))
         self.prepare_response('maze/admin.html',
-                              instagram_user=instagram_user,
-                              flickr_user=flickr_user,
+                              instagram_user=instagram_user.get_result(),
+                              flickr_user=flickr_user.get_result(),
+                              upload_url=upload_url,
+                              upload_id=self.request.GET.get('upload_id'),
                               **page_variables)
 
-    def prepare_instagram(self):
-        key = models.MazeCacheKey.instagram_user.format(self.maze.key.id())
-        user = memcache.get(key)
+    def prepare_profile(self, settings, check_user, memcache_time):
+        """Gets the profile of the user connected in the given settings. The
+        profile is cached for as long as the user access stays the same.
+
+        """
+        if not settings or not settings.user_access:
+            return None
+        key = models.profile_cache_key(settings.user_access)
+        user = cache.get(key)
         if not user:
-            user = auth.check_instagram_user_for_maze(self.maze).get_result()
+            user = check_user()
             if user:
-                memcache.set(key, user, time=MEMCACHE_TIME)
+                cache.set(key, user, time=memcache_time)
         return user
 
+    def prepare_instagram(self):
+        def check_user():
+            return auth.check_instagram_user_for_maze(self.maze).get_result()
+        return self.prepare_profile(self.maze.instagram, check_user,
+                                    Instagram.memcache_time)
+
     def prepare_flickr(self):
-        key = models.MazeCacheKey.flickr_user.format(self.maze.key.id())
-        user = memcache.get(key)
-        if not user:
+        def check_user():
             user = auth.check_flickr_user_for_maze(self.maze).get_result()
             if user:
-                user = user.getInfo()
+                try:
+                    user = user.getInfo()
+                except Exception as e:
+                    auth.handle_flickr_error(self.maze, e)
+                    return None
                 imageutil.flickr_buddy_icon(user)
-                memcache.set(key, user, time=MEMCACHE_TIME)
-        return user
+            return user
+        return self.prepare_profile(self.maze.flickr, check_user,
+                                    Flickr.memcache_time)
 
     def prepare_facebook(self):
-        key = models.MazeCacheKey.facebook_user.format(self.maze.key.id())
-        user = memcache.get(key)
-        if not user:
-            user = auth.check_facebook_user_for_maze(self.maze).get_result()
-            if user:
-                memcache.set(key, user, time=MEMCACHE_TIME)
-        return user
+        def check_user():
+            return auth.check_facebook_user_for_maze(self.maze).get_result()
+        return self.prepare_profile(self.maze.facebook, check_user,
+                                    MEMCACHE_TIME)
 
 
 class MazeAdminConnectInstagramHandler(BaseHandler):
@@ -654,8 +833,8 @@ class MazeAdminInstagramHandler(MazeAdminHandler):
         self.maze.instagram.include_feed = bool(
             ps.get('instagram-include-feed'))
         self.maze.put()
-        memcache.delete(models.MazeCacheKey.image_list
-                        .format(self.maze.key.id()))
+        self.maze.delete_cache()
+        ingest.enqueue_maze(maze_id, force=True)
         status.success[''] = 'Instagram settings updated'
         self.prepare_admin_page(maze_id, admin_key, status=status)
 
@@ -673,8 +852,8 @@ class MazeAdminFlickrHandler(MazeAdminHandler):
         self.maze.flickr.include_favs = bool(
             ps.get('flickr-include-favs'))
         self.maze.put()
-        memcache.delete(models.MazeCacheKey.image_list
-                        .format(self.maze.key.id()))
+        self.maze.delete_cache()
+        ingest.enqueue_maze(maze_id, force=True)
         status.success[''] = 'Flickr settings updated'
         self.prepare_admin_page(maze_id, admin_key, status=status)
 
@@ -701,29 +880,342 @@ class MazeAdminPasswordHandler(MazeAdminHandler):
         self.prepare_admin_page(maze_id, admin_key, status=status)
 
 
+class MazeAdminSnapshotHandler(MazeAdminHandler):
+    """Handler for freezing a maze to a snapshot and unfreezing it again.
+    Requests with ``format=json`` get the snapshot state back as JSON instead
+    of the admin page, and GET requests only return the state.
+
+    """
+    @maze_admin_required
+    def get(self, maze_id, admin_key, *args, **kwargs):
+        self.write_state()
+
+    @maze_admin_required
+    def post(self, maze_id, admin_key, *args, **kwargs):
+        status = util.html_status()
+        if self.request.POST.get('action') == 'unfreeze':
+            snapshot.unfreeze(self.maze)
+            status.success[''] = 'The maze is no longer frozen'
+        else:
+            size = mazegen.clamp_size(self.request.POST.get('size'),
+                                      config.MAZE_DEFAULT_SIZE)
+            snapshot.freeze(self.maze, size, self.uri_for)
+            status.success[''] = 'The maze is frozen'
+
+        if self.request.POST.get('format') == 'json':
+            return self.write_state()
+        self.prepare_admin_page(maze_id, admin_key, status=status)
+
+    def write_state(self):
+        frozen = (snapshot.get_snapshot(self.maze.snapshot)
+                  if self.maze.snapshot else None)
+        state = dict(frozen=bool(frozen))
+        if frozen:
+            state.update(snapshot=frozen.key.id(), size=frozen.size,
+                         created=frozen.created.isoformat())
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(state))
+
+
+class MazeAdminUploadHandler(MazeAdminHandler):
+    """Handler for uploading photos, either as separate files or zip archives.
+    The files are uploaded to the blobstore through the upload url of the admin
+    page, which then calls this handler. The photos are stored in a task and
+    the progress can be followed with GET requests using the upload ID.
+
+    """
+    @maze_admin_required
+    def get(self, maze_id, admin_key, *args, **kwargs):
+        upload_id = self.request.GET.get('upload_id', '')
+        progress = cache.get(imageutil.upload_progress_key(maze_id, upload_id))
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(progress or {}))
+
+    @maze_admin_required
+    def post(self, maze_id, admin_key, *args, **kwargs):
+        blob_keys = []
+        for field in self.request.POST.getall('files'):
+            if not hasattr(field, 'file'):
+                continue
+            try:
+                blob_keys.append(str(blobstore.parse_blob_info(field).key()))
+            except blobstore.BlobInfoParseError as e:
+                logging.exception(e)
+
+        if not blob_keys:
+            self.redirect(self.uri_for('maze-admin', maze_id=maze_id,
+                                       admin_key=admin_key,
+                                       error='No photos were uploaded'))
+            return
+
+        upload_id = security.generate_random_string(entropy=64)
+        cache.set(imageutil.upload_progress_key(maze_id, upload_id),
+                  dict(stored=0, failed=0, done=False), time=MEMCACHE_TIME)
+        deferred.defer(imageutil.store_uploaded_blobs, maze_id, upload_id,
+                       blob_keys, self.request.POST.get('message', ''))
+
+        # The blobstore only passes redirects on to the client.
+        if self.request.POST.get('format') == 'json':
+            self.redirect(self.uri_for('maze-admin-upload', maze_id=maze_id,
+                                       admin_key=admin_key,
+                                       upload_id=upload_id))
+        else:
+            self.redirect(self.uri_for('maze-admin', maze_id=maze_id,
+                                       admin_key=admin_key,
+                                       upload_id=upload_id))
+
+
 class MazeImageListHandler(BaseHandler):
     """Handler for returning a list of images for a maze."""
+    stateless = True
+
     @maze_required
     def get(self, *args, **kwargs):
         # TODO, add paging.
         size = int(self.request.GET.get('size', 0))
+        if self.write_snapshot('list', size):
+            return
+        ingest.mark_viewed(self.maze)
+
+        # Signed urls only change once per period, so the rendered list is
+        # cached with precompressed variants for the period.
+        expires = imageutil.texture_expiry()
+        cache_key = '{}:{}:{}'.format(
+            self.maze.cache_key(models.MazeCacheKey.rendered_image_list),
+            imageutil.normalize_size(size), expires)
+        variants = cache.get(cache_key)
+        if not variants:
+            images = self.prepare_signed_images(size, expires)
+            variants = util.encode_variants(json.dumps(images),
+                                            config.COMPRESS_MIN_SIZE)
+            util.cache_variants(cache, cache_key, variants, time=MEMCACHE_TIME)
+
+        self.response.content_type = 'application/json'
+        self.write_variants(variants)
+
+    def write_snapshot(self, kind, size):
+        """Writes the image list or manifest of a frozen maze. Returns False
+        if the maze is not frozen.
+
+        """
+        if not self.maze.snapshot:
+            return False
+        frozen = snapshot.get_snapshot(self.maze.snapshot)
+        if not frozen:
+            return False
+
+        etag = '"{}:{}:{}"'.format(frozen.key.id(), kind,
+                                   imageutil.normalize_size(size))
+        self.response.headers['ETag'] = etag
+        if etag in self.request.headers.get('If-None-Match', ''):
+            self.response.set_status(304)
+            return True
+        self.response.content_type = 'application/json'
+        self.write_variants(snapshot.get_variants(frozen, kind, size))
+        return True
+
+    def prepare_signed_images(self, size, expires):
+        """Returns the images of the maze as dicts with signed texture urls.
+        With composited textures, the urls point at textures with the message
+        already drawn in and the images are marked with ``comp``.
+
+        """
         images = imageutil.prepare_images_for_maze(self.maze,
                                                    size=size).get_result()
+        composite = config.COMPOSITE_TEXTURES
+        image_dicts = []
         for img in images:
-            img.url = self.uri_for('maze-texture',
-                                   maze_id=self.maze.key.id(),
-                                   image_key=base64.urlsafe_b64encode(img.url))
-        images = [img.to_dict() for img in images]
+            caption = img.message if composite else None
+            img.url = self.signed_texture_url(img.url, expires, caption)
+            if img.low_url:
+                img.low_url = self.signed_texture_url(img.low_url, expires,
+                                                      caption)
+            d = img.to_dict()
+            if composite:
+                d['comp'] = True
+            image_dicts.append(d)
+        return image_dicts
+
+    def signed_texture_url(self, url, expires, caption=None):
+        maze_id = self.maze.key.id()
+        image_key = base64.urlsafe_b64encode(url)
+        if caption is None:
+            expires, signature = imageutil.sign_texture(maze_id, image_key,
+                                                        expires)
+            return self.uri_for('maze-signed-texture',
+                                maze_id=maze_id,
+                                expires=expires,
+                                signature=signature,
+                                image_key=image_key)
+
+        expires, signature = imageutil.sign_texture(
+            maze_id, imageutil.composite_key(image_key, caption), expires)
+        return self.uri_for('maze-composite-texture',
+                            maze_id=maze_id,
+                            expires=expires,
+                            signature=signature,
+                            image_key=image_key,
+                            m=caption.encode('utf-8'))
+
+
+class MazeImageManifestHandler(MazeImageListHandler):
+    """Handler for returning the images of a maze together with the walking
+    distance of every cell of its layout, which orders the walls by distance
+    from the start, see mazegen.image_manifest. Wall i gets image i modulo the
+    number of images, so the images the player sees first are first in the
+    list. Walls further away than ``near`` should use the low-resolution url
+    of an image, when it has one.
+
+    """
+    @maze_required
+    def get(self, maze_id, *args, **kwargs):
+        size = int(self.request.GET.get('size', 0))
+        rows = mazegen.clamp_size(self.request.GET.get('rows'),
+                                  config.MAZE_DEFAULT_SIZE)
+        cols = mazegen.clamp_size(self.request.GET.get('cols'),
+                                  config.MAZE_DEFAULT_SIZE)
+        if self.write_snapshot('manifest', size):
+            return
+        ingest.mark_viewed(self.maze)
+
+        expires = imageutil.texture_expiry()
+        cache_key = '{}:{}:{}x{}:{}'.format(
+            self.maze.cache_key(models.MazeCacheKey.rendered_manifest),
+            imageutil.normalize_size(size), rows, cols, expires)
+        variants = cache.get(cache_key)
+        if not variants:
+            layout = mazegen.get_layout(mazegen.maze_seed(maze_id), rows, cols)
+            images = self.prepare_signed_images(size, expires)
+            manifest = mazegen.image_manifest(images, layout)
+            variants = util.encode_variants(json.dumps(manifest),
+                                            config.COMPRESS_MIN_SIZE)
+            util.cache_variants(cache, cache_key, variants, time=MEMCACHE_TIME)
+
         self.response.content_type = 'application/json'
-        self.response.write(json.dumps(images))
+        self.write_variants(variants)
+
+
+class MazeLayoutHandler(BaseHandler):
+    """Handler for returning the packed layout of a maze. The layout only
+    depends on the maze ID and size, so it can be cached for long.
+
+    """
+    stateless = True
+
+    @maze_required
+    def get(self, maze_id, *args, **kwargs):
+        rows = mazegen.clamp_size(self.request.GET.get('rows'),
+                                  config.MAZE_DEFAULT_SIZE)
+        cols = mazegen.clamp_size(self.request.GET.get('cols'),
+                                  config.MAZE_DEFAULT_SIZE)
+        seed = mazegen.maze_seed(maze_id)
+
+        etag = '"{}:{}x{}"'.format(seed, rows, cols)
+        self.response.headers['ETag'] = etag
+        self.response.headers['Cache-Control'] = 'private, max-age={}'.format(
+            config.CONTENT_MEMCACHE_TIME)
+        if etag in self.request.headers.get('If-None-Match', ''):
+            self.response.set_status(304)
+            return
+
+        self.response.content_type = 'application/octet-stream'
+        self.response.write(mazegen.get_layout(seed, rows, cols))
 
 
 class MazeTextureHandler(ImageHandler):
+    stateless = True
+
     @maze_required
     def get(self, maze_id, image_key, *args, **kwargs):
         self.serve_image(image_key)
 
 
+class MigrateImagesTaskHandler(webapp2.RequestHandler):
+    """Starts normalizing images that are not stored as contents yet."""
+    def get(self, *args, **kwargs):
+        deferred.defer(imageutil.migrate_image_contents)
+        self.response.write('Migration started')
+
+
+class MazeSignedTextureHandler(ImageHandler):
+    """Serves textures from signed urls made by the image list handler. Access
+    to the maze has already been checked when the list was made, so only the
+    signature is verified here.
+
+    """
+    stateless = True
+
+    def get(self, maze_id, expires, signature, image_key, *args, **kwargs):
+        if not imageutil.verify_texture(maze_id, image_key, expires,
+                                        signature):
+            self.abort(403)
+        self.serve_image(image_key)
+
+
+class MazeSnapshotTextureHandler(ImageHandler):
+    """Serves the textures of a frozen maze. Only image keys in the snapshot
+    are served and the textures are kept in the cache without expiry, since
+    they never change for a snapshot.
+
+    """
+    stateless = True
+
+    @maze_required
+    def get(self, maze_id, snapshot_id, image_key, *args, **kwargs):
+        key = ndb.Key(models.Maze, maze_id,
+                      models.MazeSnapshot, int(snapshot_id))
+        frozen = snapshot.get_snapshot(key)
+        if not frozen or image_key not in frozen.image_keys:
+            self.abort(404)
+
+        cache_key = 'snapshot:{}:texture:{}'.format(
+            key.urlsafe(), hashlib.sha1(image_key).hexdigest())
+        image = cache.get(cache_key)
+        if image is None:
+            caption = frozen.image_keys[image_key]
+            if caption is None:
+                image = self.load_image(image_key)
+            else:
+                image = self.load_composite(image_key, caption)
+            if not image:
+                self.abort(404)
+            if len(image[0]) < 800000:
+                try:
+                    cache.set(cache_key, image)
+                except Exception as e:
+                    logging.exception(e)
+        self.write_image(*image, max_age=config.SNAPSHOT_TEXTURE_TIME)
+
+
+class MazeCompositeTextureHandler(ImageHandler):
+    """Serves composited textures from signed urls. The caption is part of
+    the signature, so only the maze's own messages are drawn.
+
+    """
+    stateless = True
+
+    def get(self, maze_id, expires, signature, image_key, *args, **kwargs):
+        caption = self.request.GET.get('m', u'')
+        if not imageutil.verify_texture(
+                maze_id, imageutil.composite_key(image_key, caption), expires,
+                signature):
+            self.abort(403)
+        self.serve_composite(image_key, caption)
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    """Loads what the first real requests on a new instance would otherwise
+    wait for."""
+    def get(self, *args, **kwargs):
+        config.preload_templates(JINJA)
+        flickr_api.load()
+        instagram.load()
+        try:
+            imageutil.flickr_license('')
+        except Exception as e:
+            logging.exception(e)
+
+
 def handle_http_exception(request, response, exception):
     """Custom exception handler for all failed requests.
     """
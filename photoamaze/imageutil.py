@@ -9,14 +9,20 @@
 
 """
 import base64
+import hashlib
+import hmac
 import logging
+import mimetypes
 import threading
+import time
+import zipfile
 
-import flickr_api
-from google.appengine.api import memcache
-from google.appengine.ext import ndb
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore, deferred, ndb
 
-from photoamaze import config, models, auth
+from photoamaze import config, models, auth, util
+from photoamaze.auth import flickr_api
+from photoamaze.backends import cache, resize_async
 
 EXTERNAL_INSTAGRAM = 'i'
 EXTERNAL_FLICKR = 'f'
@@ -30,6 +36,25 @@ FLICKR_LICENSES_PUBLIC = '1,2,3,4,5,6,7,8'  # Not "All rights reserved".
 FLICKR_LICENSES = None
 FLICKR_LOCK = threading.Lock()
 
+# Sizes that external images are indexed with.
+INDEX_SIZES = (256, 512, 1024)
+
+# Image keys that recently could not be loaded, image key -> expiry time.
+MISSING_IMAGES = {}
+MISSING_IMAGES_LOCK = threading.Lock()
+MISSING_IMAGES_SIZE = 10000
+
+# Names of the external image sources of a maze.
+SOURCE_FLICKR_SEARCH = 'flickr-search'
+SOURCE_FLICKR_RECENT = 'flickr-recent'
+SOURCE_FLICKR_FAVS = 'flickr-favs'
+SOURCE_INSTAGRAM_TAG = 'instagram-tag'
+SOURCE_INSTAGRAM_RECENT = 'instagram-recent'
+SOURCE_INSTAGRAM_FEED = 'instagram-feed'
+SOURCES = (SOURCE_FLICKR_SEARCH, SOURCE_FLICKR_RECENT, SOURCE_FLICKR_FAVS,
+           SOURCE_INSTAGRAM_TAG, SOURCE_INSTAGRAM_RECENT,
+           SOURCE_INSTAGRAM_FEED)
+
 
 def __prepare_search(s, remove_whitespace=False, error_message=None):
     s = s.strip() if s else ''
@@ -87,110 +112,247 @@ def __prepare_instagram_media(media_list, size=1024):
     return imagelist
 
 
-@ndb.tasklet
-def __prepare_internal_images_for_maze(maze, size, page, page_size):
+def __collect_pages(fetch_page, limit, convert, stop_at=None):
+    """Follows the pagination of a provider feed until ``limit`` entries have
+    been collected, there are no more pages or the entry with ID ``stop_at`` is
+    reached.
+
+    ``fetch_page`` is called with ``None`` for the first page and with the
+    returned next page token for every following page. ``convert`` turns the
+    items of a page into a list of ``(item_id, value)`` entries, where the ID
+    is the ``id`` of the item. The next page is fetched in the background
+    while the current page is being converted, unless the current page is the
+    last one needed.
+
+    """
+    entries = []
+    if limit <= 0:
+        return entries
+
+    items, next_page = fetch_page(None)
+    while True:
+        prefetch = None
+        stops = stop_at is not None and any(str(item.id) == stop_at
+                                            for item in items)
+        if next_page and not stops and len(entries) + len(items) < limit:
+            prefetch = util.ThreadResult(fetch_page, next_page)
+
+        for entry in convert(items):
+            if stop_at is not None and entry[0] == stop_at:
+                return entries[:limit]
+            entries.append(entry)
+
+        if len(entries) >= limit or not prefetch:
+            break
+
+        try:
+            items, next_page = prefetch.get_result()
+        except Exception as e:
+            # Keep what we have so far if a later page fails.
+            logging.exception(e)
+            break
+
+    return entries[:limit]
+
+
+def __instagram_pager(api_method, *args, **kwargs):
+    """Returns a page fetcher for the given Instagram API method."""
+    def fetch_page(next_url):
+        if next_url:
+            return api_method(with_next_url=next_url)
+        return api_method(*args, **kwargs)
+    return fetch_page
+
+
+def __flickr_pager(api_method, **kwargs):
+    """Returns a page fetcher for the given Flickr API method."""
+    def fetch_page(page):
+        page = page or 1
+        photos = api_method(page=page, **kwargs)
+        info = getattr(photos, 'info', None)
+        pages = getattr(info, 'pages', 0) or 0
+        return photos, page + 1 if page < pages else None
+    return fetch_page
+
+
+def __index_converter(prepare):
+    """Returns a converter that prepares each provider item once per index size
+    and returns ``(item_id, {size: LocalImage})`` entries.
+
+    """
+    def convert(items):
+        entries = []
+        for item in items:
+            images = {}
+            for size in INDEX_SIZES:
+                prepared = prepare([item], size)
+                if prepared:
+                    images[size] = prepared[0]
+            if images:
+                entries.append((str(item.id), images))
+        return entries
+    return convert
+
+
+def normalize_size(size):
+    """Maps a requested texture size to one of the index sizes."""
     # Use the breakpoint values from bootstrap's responsive classes.
     # Extra small
     size = size or 0
     if size < 768:
-        size = 256
+        return 256
     # Small
     elif 768 <= size < 992:
-        size = 512
+        return 512
     # Eveything else (desktop)
-    else:
-        size = 1024
+    return 1024
 
+
+@ndb.tasklet
+def __prepare_internal_images_for_maze(maze, size):
     q = models.MazeImage.query(ancestor=maze.key)
-    # TODO: Add support for page number.
-    entities, next_cursor, more = yield q.fetch_page_async(page_size)
+    entities = yield q.fetch_async(config.UPLOAD_MAX_IMAGES)
 
     image_list = []
     for entity in entities:
-        image_key = 'b;{};{}'.format(entity.key.urlsafe(), size)
-        img = models.LocalImage(image_key, entity.message)
+        # Images with shared contents are served by their content.
+        if entity.content:
+            image_key = 'c;{};{}'.format(entity.content.id(), '{}')
+        else:
+            image_key = 'b;{};{}'.format(entity.key.urlsafe(), '{}')
+        img = models.LocalImage(image_key.format(size), entity.message)
+        if size > INDEX_SIZES[0]:
+            img.low_url = image_key.format(INDEX_SIZES[0])
         image_list.append(img)
 
     raise ndb.Return(image_list)
 
 
 @ndb.tasklet
-def __prepare_flickr_images_for_maze(maze, size, page, page_size):
+def __prepare_indexed_images_for_maze(maze, size):
+    q = models.MazeIndexImage.query(ancestor=maze.key)
+    entities = yield q.fetch_async(config.INDEX_MAX_IMAGES)
+    image_list = []
+    for entity in entities:
+        img = entity.to_local_image(size)
+        if img:
+            low = entity.to_local_image(INDEX_SIZES[0])
+            if low.url != img.url:
+                img.low_url = low.url
+            image_list.append(img)
+    raise ndb.Return(image_list)
+
+
+@ndb.tasklet
+def __flickr_sources_for_maze(maze):
+    sources = {}
+    if not maze.flickr:
+        raise ndb.Return(sources)
+
     # Find a Flickr user, if it exists.
     flickr_user = yield auth.check_flickr_user_for_maze(maze)
     token = flickr_user.getToken() if flickr_user else None
+    user_id = flickr_user.id if flickr_user else ''
+    convert = __index_converter(__prepare_flickr_photos)
+    page_size = config.Flickr.page_size
 
-    image_set = set()
+    if maze.flickr.tags or maze.flickr.user:
+        tags, user, license = __prepare_flickr_search(maze.flickr.tags,
+                                                      maze.flickr.user,
+                                                      token)
+        fetch_page = __flickr_pager(flickr_api.Photo.search,
+                                    user_id=user,
+                                    tags=tags,
+                                    per_page=page_size,
+                                    media='photos',
+                                    extras=FLICKR_EXTRAS,
+                                    license=license,
+                                    token=token)
+        sources[SOURCE_FLICKR_SEARCH] = (u'{};{};{}'.format(tags, user, license),
+                                         fetch_page, convert)
 
-    try:
-        if maze.flickr.tags or maze.flickr.user:
-            image_set.update(flickr_search(maze.flickr.tags, maze.flickr.user,
-                                           auth=token, size=size, page=page,
-                                           page_size=page_size))
-
-        if flickr_user and maze.flickr.include_recent:
-            photos = flickr_user.getPhotos(token=token,
-                                           extras=FLICKR_EXTRAS,
-                                           page=page,
-                                           per_page=page_size)
-            image_set.update(__prepare_flickr_photos(photos, size))
-
-        if flickr_user and maze.flickr.include_favs:
-            photos = flickr_user.getFavorites(token=token,
-                                              extras=FLICKR_EXTRAS,
-                                              page=page,
-                                              per_page=page_size)
-            image_set.update(__prepare_flickr_photos(photos, size))
-    except Exception as e:
-        # For now, just log everything.
-        logging.exception(e)
+    if flickr_user and maze.flickr.include_recent:
+        fetch_page = __flickr_pager(flickr_user.getPhotos,
+                                    token=token,
+                                    extras=FLICKR_EXTRAS,
+                                    per_page=page_size)
+        sources[SOURCE_FLICKR_RECENT] = (user_id, fetch_page, convert)
+
+    if flickr_user and maze.flickr.include_favs:
+        fetch_page = __flickr_pager(flickr_user.getFavorites,
+                                    token=token,
+                                    extras=FLICKR_EXTRAS,
+                                    per_page=page_size)
+        sources[SOURCE_FLICKR_FAVS] = (user_id, fetch_page, convert)
 
-    raise ndb.Return(list(image_set))
+    raise ndb.Return(sources)
 
 
 @ndb.tasklet
-def __prepare_instagram_images_for_maze(maze, size, page, page_size):
+def __instagram_sources_for_maze(maze):
+    sources = {}
     api = None
 
     # Check if user specific API calls are possible.
-    if maze.instagram.user_access:
+    if maze.instagram and maze.instagram.user_access:
         user_access = yield maze.instagram.user_access.get_async()
         if user_access:
             api = auth.init_instagram(access_token=user_access.access_token)
 
     if not api:
-        raise ndb.Return([])
+        raise ndb.Return(sources)
 
-    image_set = set()
+    user_id = maze.instagram.user_access.id()
+    convert = __index_converter(__prepare_instagram_media)
+    page_size = config.Instagram.page_size
 
-    try:
-        if maze.instagram.tag:
-            images = instagram_search_tag(maze.instagram.tag, api)
-            image_set.update(images)
+    if maze.instagram.tag:
+        tag = __prepare_search(maze.instagram.tag, True)
+        if tag:
+            fetch_page = __instagram_pager(api.tag_recent_media,
+                                           page_size, None, tag)
+            sources[SOURCE_INSTAGRAM_TAG] = (tag, fetch_page, convert)
 
-        if maze.instagram.include_recent:
-            recent_media, next_ = api.user_recent_media()
-            image_set.update(__prepare_instagram_media(recent_media))
+    if maze.instagram.include_recent:
+        fetch_page = __instagram_pager(api.user_recent_media, count=page_size)
+        sources[SOURCE_INSTAGRAM_RECENT] = (user_id, fetch_page, convert)
 
-        if maze.instagram.include_feed:
-            recent_media, next_ = api.user_media_feed()
-            image_set.update(__prepare_instagram_media(recent_media))
-    except Exception as e:
-        # For now, just log everything.
-        logging.exception(e)
+    if maze.instagram.include_feed:
+        fetch_page = __instagram_pager(api.user_media_feed, count=page_size)
+        sources[SOURCE_INSTAGRAM_FEED] = (user_id, fetch_page, convert)
 
-    raise ndb.Return(list(image_set))
+    raise ndb.Return(sources)
 
 
-def instagram_search_tag(tag, api, size=1024):
-    tag = __prepare_search(tag, True, 'Tag is invalid')
-    medias, _next = api.tag_recent_media(20, None, tag)
-    images = set()
-    images.update(__prepare_instagram_media(medias, size=size))
-    return list(images)
+@ndb.tasklet
+def sources_for_maze(maze):
+    """Finds the external image sources configured for the given maze.
 
+    Returns a dictionary of source name to a ``(settings, fetch_page,
+    convert)`` tuple where ``settings`` identifies the source configuration.
+    Only the ingestion worker should call this, as preparing the sources may
+    require calls to the providers.
 
-def flickr_search(tags, user, auth=None, size=1024, page=1, page_size=30):
+    """
+    flickr, instagram = yield (__flickr_sources_for_maze(maze),
+                               __instagram_sources_for_maze(maze))
+    sources = {}
+    sources.update(flickr)
+    sources.update(instagram)
+    raise ndb.Return(sources)
+
+
+def collect_source(source, limit, stop_at=None):
+    """Collects up to ``limit`` index entries from a source returned by
+    :func:`sources_for_maze`, newest first, stopping at the entry with ID
+    ``stop_at``.
+
+    """
+    settings, fetch_page, convert = source
+    return __collect_pages(fetch_page, limit, convert, stop_at=stop_at)
+
+
+def __prepare_flickr_search(tags, user, auth):
     tags = __prepare_search(tags)
     user = __prepare_search(user)
 
@@ -204,6 +366,12 @@ def flickr_search(tags, user, auth=None, size=1024, page=1, page_size=30):
     if not auth:
         license = FLICKR_LICENSES_PUBLIC
 
+    return tags, user, license
+
+
+def flickr_search(tags, user, auth=None, size=1024, page=1, page_size=30):
+    tags, user, license = __prepare_flickr_search(tags, user, auth)
+
     photos = []
     try:
         photos = flickr_api.Photo.search(user_id=user,
@@ -219,6 +387,606 @@ def flickr_search(tags, user, auth=None, size=1024, page=1, page_size=30):
     return __prepare_flickr_photos(photos, size)
 
 
+def __texture_signature(maze_id, image_key, expires):
+    msg = '{}:{}:{}'.format(maze_id, image_key, expires)
+    digest = hmac.new(config.TEXTURE_KEY, msg, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:18])
+
+
+def texture_expiry():
+    """Returns the expiry time for texture urls signed now. It only changes
+    once per TEXTURE_URL_TIME period."""
+    period = config.TEXTURE_URL_TIME
+    return (int(time.time()) // period + 2) * period
+
+
+def sign_texture(maze_id, image_key, expires=None):
+    """Signs an encoded image key for a maze. The image key includes the size.
+    Returns a tuple of the expiry time and the signature.
+
+    """
+    expires = expires or texture_expiry()
+    return expires, __texture_signature(maze_id, image_key, expires)
+
+
+def verify_texture(maze_id, image_key, expires, signature):
+    """Verifies a signature from :func:`sign_texture`."""
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires < time.time():
+        return False
+    try:
+        expected = __texture_signature(maze_id, image_key, expires)
+        signature = str(signature)
+    except UnicodeError:
+        # Signatures and signed keys are always ASCII.
+        return False
+    return hmac.compare_digest(expected, signature)
+
+
+def is_missing(image_key):
+    """Checks whether an encoded image key recently could not be loaded."""
+    expires = MISSING_IMAGES.get(image_key)
+    return expires is not None and expires > time.time()
+
+
+def remember_missing(image_key):
+    """Remembers that an encoded image key could not be loaded, so requests
+    for it are answered without looking it up again for a while.
+
+    """
+    with MISSING_IMAGES_LOCK:
+        if len(MISSING_IMAGES) >= MISSING_IMAGES_SIZE:
+            now = time.time()
+            for key, expires in MISSING_IMAGES.items():
+                if expires <= now:
+                    del MISSING_IMAGES[key]
+            if len(MISSING_IMAGES) >= MISSING_IMAGES_SIZE:
+                MISSING_IMAGES.clear()
+        MISSING_IMAGES[image_key] = time.time() + config.MISSING_IMAGE_TIME
+
+
+def decode_image_key(image_key):
+    """Decodes an encoded image key into its type, url key and size."""
+    return base64.urlsafe_b64decode(str(image_key)).split(';')
+
+
+def external_url(image_url_key):
+    """Returns the url of an external image from its url key."""
+    return base64.b64decode(image_url_key)
+
+
+def external_cache_time(img_type):
+    """Returns how long images of the given type are cached, or None if the
+    type is not an external image.
+
+    """
+    if img_type == EXTERNAL_FLICKR:
+        return config.Flickr.memcache_time
+    elif img_type == EXTERNAL_INSTAGRAM:
+        return config.Instagram.memcache_time
+    return None
+
+
+def is_external(image_key):
+    """Checks whether an encoded image key points to an external image.
+    Public image urls are unsigned, so only those may be served from them.
+
+    """
+    try:
+        img_type = decode_image_key(image_key)[0]
+    except (TypeError, ValueError):
+        return False
+    return external_cache_time(img_type) is not None
+
+
+def cache_external(url, content, cache_time):
+    """Caches the contents of an external image, unless it is too large."""
+    # If the contents are less than 800KB, try and store it in memcache.
+    if len(content) < 800000:
+        try:
+            cache.set(url, content, time=cache_time)
+        except Exception as e:
+            logging.exception(e)
+
+
+def external_content_type(url, content_type=None):
+    """Returns the given content type or, if there is none, guesses it from
+    the url."""
+    if content_type:
+        return content_type
+    return mimetypes.guess_type(url)[0] or 'image/jpeg'
+
+
+def load_internal_image(img_type, img_url_key, size):
+    """Loads an uploaded image, either a blob ('b') or shared contents ('c').
+    Returns a tuple of the contents and content type, or None if there is no
+    such image.
+
+    """
+    if img_type == 'b':  # Blob
+        return __load_blob(img_url_key, size)
+    elif img_type == 'c':  # Shared content
+        return __load_content(img_url_key, size)
+    return None
+
+
+def __maze_image_key(image_key):
+    """Decodes the urlsafe key of a MazeImage. Returns None for anything else,
+    since the key comes from the url."""
+    try:
+        key = ndb.Key(urlsafe=image_key)
+    except Exception:
+        # Bad keys fail in many ways, from padding errors to protocol buffer
+        # decode errors.
+        return None
+    if key.kind() != models.MazeImage._get_kind():
+        return None
+    # Keys of other apps or namespaces are looked up here instead.
+    return ndb.Key(pairs=key.pairs())
+
+
+def __load_content(digest, size):
+    try:
+        size = int(size)
+    except ValueError:
+        return None
+    if size not in INDEX_SIZES:
+        size = INDEX_SIZES[-1]
+
+    # Contents are shared, so the cache entries are too.
+    cache_key = 'content:{}:{}'.format(digest, size)
+    img = cache.get(cache_key)
+    if img is None:
+        key = ndb.Key(models.ImageContent, digest,
+                      models.ImageRendition, size)
+        rendition = key.get()
+        if not rendition:
+            return None
+        img = rendition.image
+        if len(img) < 800000:
+            try:
+                cache.set(cache_key, img, time=config.CONTENT_MEMCACHE_TIME)
+            except Exception as e:
+                logging.exception(e)
+
+    return img, 'image/jpeg'
+
+
+def __load_blob(image_key, size):
+    key = __maze_image_key(image_key)
+    maze_image = key.get() if key else None
+    if not maze_image:
+        return None
+
+    # Images from before contents were normalized at ingest are normalized on
+    # first request.
+    if not maze_image.content:
+        normalize_images([maze_image])
+
+    if maze_image.content:
+        return __load_content(maze_image.content.id(), size)
+    return None
+
+
+def composite_key(image_key, caption):
+    """Returns the key to sign for a composited texture of an image key with
+    the given caption.
+
+    """
+    return '{}:{}'.format(image_key,
+                          hashlib.sha1(caption.encode('utf-8')).hexdigest())
+
+
+def composite_texture(data, caption):
+    """Composites an image into a square power-of-two JPEG texture. The image
+    is scaled so its longest side fills the texture, letterboxed on black and
+    the caption is drawn in the letterbox, like static/js/src/photomaze.js
+    does on the client.
+
+    """
+    from cStringIO import StringIO
+    from PIL import Image
+
+    img = Image.open(StringIO(data))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    # Use the smallest texture size that fits the image without scaling down.
+    longest = max(img.size)
+    size = ([s for s in INDEX_SIZES if s >= longest] or [INDEX_SIZES[-1]])[0]
+    scale = float(size) / longest
+    width = max(1, int(round(img.size[0] * scale)))
+    height = max(1, int(round(img.size[1] * scale)))
+    img = img.resize((width, height), Image.ANTIALIAS)
+
+    texture = Image.new('RGB', (size, size), 'black')
+    offset_x = (size - width) // 2
+    offset_y = (size - height) // 2
+    texture.paste(img, (offset_x, offset_y))
+
+    # The caption goes in the letterbox band along the longest side.
+    band = offset_x if width < height else offset_y
+    text = None
+    if caption and band >= 4:
+        try:
+            text = __render_caption(caption, band // 2, int(size * 0.95))
+        except Exception as e:
+            # E.g. characters the font cannot draw. The texture is still
+            # usable without the caption.
+            logging.exception(e)
+    if text:
+        if width < height:
+            text = text.rotate(90, expand=True)
+            position = ((band - text.size[0]) // 2,
+                        (size - text.size[1]) // 2)
+        else:
+            position = ((size - text.size[0]) // 2,
+                        size - band + (band - text.size[1]) // 2)
+        texture.paste(text, position, text)
+
+    out = StringIO()
+    texture.save(out, 'JPEG', quality=85)
+    return out.getvalue()
+
+
+def __render_caption(caption, height, max_width):
+    """Renders a caption as white text with a black outline on a transparent
+    image of about the given height, no wider than max_width.
+
+    """
+    from PIL import Image, ImageDraw, ImageFont
+
+    font = None
+    if config.TEXTURE_FONT:
+        try:
+            font = ImageFont.truetype(config.TEXTURE_FONT, height)
+        except (IOError, ImportError) as e:
+            logging.exception(e)
+    if font is None:
+        font = ImageFont.load_default()
+
+    draw = ImageDraw.Draw(Image.new('L', (1, 1)))
+    text_width, text_height = draw.textsize(caption, font=font)
+    text = Image.new('RGBA', (text_width + 2, text_height + 2), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(text)
+    for dx, dy in ((0, 0), (2, 0), (0, 2), (2, 2)):
+        draw.text((dx, dy), caption, font=font, fill=(0, 0, 0, 255))
+    draw.text((1, 1), caption, font=font, fill=(255, 255, 255, 255))
+
+    # The default font has a fixed size, so it is scaled to the height.
+    scale = min(float(height) / text.size[1], float(max_width) / text.size[0])
+    if abs(scale - 1) > 0.1:
+        text = text.resize((max(1, int(text.size[0] * scale)),
+                            max(1, int(text.size[1] * scale))),
+                           Image.ANTIALIAS)
+    return text
+
+
+def is_image_filename(filename):
+    """Checks whether the given filename looks like an image."""
+    content_type = mimetypes.guess_type(filename or '')[0] or ''
+    return content_type.startswith('image/')
+
+
+def __start_renditions(data):
+    """Starts resizing an image to every texture size. This is where images are
+    normalized: the EXIF orientation is applied and re-encoding to JPEG strips
+    EXIF and ICC metadata, so serving the renditions is a plain byte copy.
+    Returns a dict of size to RPC.
+
+    """
+    return dict((size, resize_async(data, size, correct_orientation=True))
+                for size in INDEX_SIZES)
+
+
+def __store_contents(batch):
+    """Stores the contents of a batch of ``(message, digest, data)`` images.
+    Contents that are already stored are only referenced, all other renditions
+    are generated in parallel. Returns the set of stored digests.
+
+    """
+    counts = {}
+    for _, digest, _ in batch:
+        counts[digest] = counts.get(digest, 0) + 1
+
+    # Reference the contents that already exist.
+    futures = dict((digest, models.ImageContent.add_references_async(digest,
+                                                                     count))
+                   for digest, count in counts.items())
+    missing = set(digest for digest, future in futures.items()
+                  if not future.get_result())
+
+    # Generate renditions for new contents.
+    rpcs = {}
+    for _, digest, data in batch:
+        if digest in missing and digest not in rpcs:
+            try:
+                rpcs[digest] = __start_renditions(data)
+            except Exception as e:
+                logging.exception(e)
+
+    futures = {}
+    for digest, content_rpcs in rpcs.items():
+        content_key = ndb.Key(models.ImageContent, digest)
+        try:
+            renditions = [models.ImageRendition(id=size, parent=content_key,
+                                                image=rpc.get_result())
+                          for size, rpc in content_rpcs.items()]
+        except Exception as e:
+            logging.exception(e)
+            continue
+        futures[digest] = models.ImageContent.add_references_async(
+            digest, counts[digest], renditions=renditions)
+
+    stored = set(digest for digest in counts if digest not in missing)
+    for digest, future in futures.items():
+        try:
+            if future.get_result():
+                stored.add(digest)
+        except Exception as e:
+            logging.exception(e)
+
+    return stored
+
+
+def __store_batch(maze_key, batch):
+    """Stores a batch of ``(message, digest, data)`` images with a single batch
+    write. Returns the number of stored images."""
+    stored = __store_contents(batch)
+    images = [models.MazeImage(parent=maze_key,
+                               content=ndb.Key(models.ImageContent, digest),
+                               message=message)
+              for message, digest, _ in batch if digest in stored]
+    ndb.put_multi(images)
+    return len(images)
+
+
+def store_images(maze_key, uploads, progress=None):
+    """Stores uploaded images for a maze.
+
+    ``uploads`` is an iterable of ``(message, data)`` tuples, which is consumed
+    lazily so only a batch of images is held in memory at a time. Image
+    contents are stored once by their SHA-256, no matter how many mazes use
+    them. ``progress`` is called with the number of stored and failed images
+    after each batch.
+
+    Returns a tuple of the number of stored and failed images.
+
+    """
+    stored = failed = 0
+    batch = []
+
+    def flush():
+        count = __store_batch(maze_key, batch)
+        size = len(batch)
+        del batch[:]
+        return count, size - count
+
+    for message, data in uploads:
+        batch.append((message, hashlib.sha256(data).hexdigest(), data))
+        if len(batch) >= config.UPLOAD_BATCH_SIZE:
+            count, errors = flush()
+            stored += count
+            failed += errors
+            if progress:
+                progress(stored, failed)
+
+    if batch:
+        count, errors = flush()
+        stored += count
+        failed += errors
+        if progress:
+            progress(stored, failed)
+
+    if stored:
+        models.delete_maze_cache(maze_key.id())
+    return stored, failed
+
+
+def upload_progress_key(maze_id, upload_id):
+    return '{}:upload:{}'.format(maze_id, upload_id)
+
+
+def __iter_blob_uploads(blob_keys, message, position):
+    """Yields ``(message, data)`` for every image in the given uploaded blobs.
+    Zip archives are read one entry at a time straight from the blobstore.
+
+    ``position`` is a ``[blob, entry]`` list with the index of the blob and of
+    the entry in a zip archive to start from. It is kept pointing at the image
+    after the last one yielded.
+
+    """
+    start_blob, start_entry = position
+    for i, info in enumerate(blobstore.BlobInfo.get(blob_keys)):
+        if i < start_blob or not info:
+            continue
+        if info.filename.lower().endswith('.zip'):
+            try:
+                archive = zipfile.ZipFile(blobstore.BlobReader(info))
+            except zipfile.BadZipfile as e:
+                logging.exception(e)
+                continue
+            for j, entry in enumerate(archive.infolist()):
+                if i == start_blob and j < start_entry:
+                    continue
+                if (is_image_filename(entry.filename) and
+                        entry.file_size <= config.UPLOAD_MAX_SIZE):
+                    position[:] = [i, j + 1]
+                    yield message, archive.read(entry)
+            archive.close()
+        elif (is_image_filename(info.filename) and
+                info.size <= config.UPLOAD_MAX_SIZE):
+            position[:] = [i + 1, 0]
+            yield message, blobstore.BlobReader(info).read()
+
+
+def store_uploaded_blobs(maze_id, upload_id, blob_keys, message):
+    """Stores the images of files uploaded to the blobstore for a maze and
+    deletes the files. Meant to run in a task, so uploads are not bound by the
+    request deadline. The position is saved with every stored batch, so a
+    retried task continues where the last one left off. The progress is kept
+    in the cache under :func:`upload_progress_key`.
+
+    """
+    maze_key = ndb.Key(models.Maze, maze_id)
+    progress_key = upload_progress_key(maze_id, upload_id)
+    upload = models.MazeUpload.get_or_insert(upload_id, parent=maze_key)
+    position = [upload.blob, upload.entry]
+    start_stored, start_failed = upload.stored, upload.failed
+
+    def progress(stored, failed, done=False):
+        upload.blob, upload.entry = position
+        upload.stored = start_stored + stored
+        upload.failed = start_failed + failed
+        upload.put()
+        cache.set(progress_key, dict(stored=upload.stored, failed=upload.failed,
+                                     done=done),
+                  time=config.MEMCACHE_TIME)
+
+    stored, failed = store_images(
+        maze_key, __iter_blob_uploads(blob_keys, message, position),
+        progress=progress)
+    progress(stored, failed, done=True)
+    blobstore.delete(blob_keys)
+    upload.key.delete()
+
+
+def normalize_images(images):
+    """Moves the image data of MazeImages that still store bytes or blobstore
+    blobs to normalized ImageContents. Returns the normalized images.
+
+    """
+    batch = []
+    legacy = []
+    for img in images:
+        if img.content:
+            continue
+        data = img.image
+        if not data and img.image_key:
+            reader = blobstore.BlobReader(img.image_key)
+            data = reader.read(config.UPLOAD_MAX_SIZE + 1)
+            if len(data) > config.UPLOAD_MAX_SIZE:
+                logging.warning('Image {} is too large'.format(img.key))
+                continue
+        if data:
+            batch.append((img.message, hashlib.sha256(data).hexdigest(),
+                          data))
+            legacy.append(img)
+
+    if not batch:
+        return []
+
+    stored = __store_contents(batch)
+    normalized = []
+    blob_keys = []
+    for img, (_, digest, _) in zip(legacy, batch):
+        if digest in stored:
+            if img.image_key:
+                blob_keys.append(img.image_key)
+            img.content = ndb.Key(models.ImageContent, digest)
+            img.image = None
+            img.image_key = None
+            normalized.append(img)
+    ndb.put_multi(normalized)
+    if blob_keys:
+        blobstore.delete(blob_keys)
+    for maze_id in set(img.key.parent().id() for img in normalized):
+        models.delete_maze_cache(maze_id)
+    return normalized
+
+
+@ndb.transactional
+def __record_blob_info(key, width, height, upright):
+    # The image may have been normalized in the meantime.
+    maze_image = key.get()
+    if maze_image and not maze_image.content:
+        maze_image.width = width
+        maze_image.height = height
+        maze_image.upright = upright
+        maze_image.put()
+
+
+def __inspect_blob(maze_image):
+    """Records the dimensions and orientation of the blob of a MazeImage. Only
+    the header of the image is read. Returns False if the blob could not be
+    read.
+
+    """
+    try:
+        from PIL import Image
+        img = Image.open(blobstore.BlobReader(maze_image.image_key))
+        exif = img._getexif() if hasattr(img, '_getexif') else None
+    except Exception as e:
+        logging.exception(e)
+        return False
+    maze_image.width, maze_image.height = img.size
+    maze_image.upright = (exif or {}).get(0x0112, 1) == 1
+    __record_blob_info(maze_image.key, maze_image.width, maze_image.height,
+                       maze_image.upright)
+    return True
+
+
+def streamable_blob(image_key, size):
+    """Returns the BlobInfo of a MazeImage that is still stored as a blobstore
+    blob, if the original can be served as the texture of the given size as it
+    is: it fits the size and needs no EXIF orientation. It can then be
+    streamed instead of being read into memory to be normalized, which is left
+    to a background task. Returns None for all other images.
+
+    """
+    try:
+        size = int(size)
+    except ValueError:
+        return None
+    key = __maze_image_key(image_key)
+    maze_image = key.get() if key else None
+    if not maze_image or maze_image.content or not maze_image.image_key:
+        return None
+    if maze_image.upright is None and not __inspect_blob(maze_image):
+        return None
+    if (not maze_image.upright or
+            max(maze_image.width, maze_image.height) > size):
+        return None
+    info = blobstore.BlobInfo.get(maze_image.image_key)
+    if not info:
+        return None
+
+    name = 'normalize-{}'.format(hashlib.sha1(image_key).hexdigest())
+    try:
+        deferred.defer(normalize_image, image_key, _name=name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+    return info
+
+
+def normalize_image(image_key):
+    """Normalizes a single MazeImage, see :func:`normalize_images`."""
+    key = __maze_image_key(image_key)
+    maze_image = key.get() if key else None
+    if maze_image:
+        normalize_images([maze_image])
+
+
+def migrate_image_contents(cursor=None):
+    """Normalizes all MazeImages that still store bytes or blobstore blobs, so
+    listing the images of a maze never loads image bytes and serving them never
+    has to correct the orientation. Runs as a chain of deferred tasks.
+
+    """
+    q = models.MazeImage.query()
+    images, next_cursor, more = q.fetch_page(config.UPLOAD_BATCH_SIZE,
+                                             start_cursor=cursor)
+    normalized = normalize_images(images)
+    if normalized:
+        logging.info('Migrated {} images'.format(len(normalized)))
+
+    if more and next_cursor:
+        deferred.defer(migrate_image_contents, cursor=next_cursor)
+
+
 def flickr_buddy_icon(person):
     """Adds a buddy icon url to the given person."""
     buddyicon = FLICKR_BUDDYICON_URL
@@ -242,7 +1010,7 @@ def flickr_license(license_id):
             # Double checked locking
             if not FLICKR_LICENSES:
                 cache_key = 'flickr_licenses'
-                FLICKR_LICENSES = memcache.get(cache_key)
+                FLICKR_LICENSES = cache.get(cache_key)
                 if not FLICKR_LICENSES:
                     FLICKR_LICENSES = {}
                     license_list = flickr_api.License.getList()
@@ -251,25 +1019,28 @@ def flickr_license(license_id):
                             'name': license.name,
                             'url': license.url
                         }
-                    memcache.set(cache_key, FLICKR_LICENSES)
+                    cache.set(cache_key, FLICKR_LICENSES)
     return FLICKR_LICENSES.get(license_id)
 
 
 @ndb.tasklet
-def prepare_images_for_maze(maze, page=1, page_size=20, size=0):
-    cache_key = '{}:imagelist'.format(maze.key.id())
-    image_list = memcache.get(cache_key)
+def prepare_images_for_maze(maze, size=0):
+    """Prepares the image list for a maze from its own images and its image
+    index. External providers are never called from here, the index is filled
+    in the background by :mod:`photoamaze.ingest`.
+
+    """
+    size = normalize_size(size)
+    cache_key = '{}:{}'.format(maze.cache_key(models.MazeCacheKey.image_list),
+                               size)
+    image_list = cache.get(cache_key)
 
     if not image_list:
-        image_list = []
-        internal = __prepare_internal_images_for_maze(maze, size,
-                                                      page, page_size)
-        flickr = __prepare_flickr_images_for_maze(maze, size, page, page_size)
-        instagram = __prepare_instagram_images_for_maze(maze, size,
-                                                        page, page_size)
-
-        internal, flickr, instagram = yield internal, flickr, instagram
-        image_list = internal + flickr + instagram
-        memcache.set(cache_key, image_list, time=config.MEMCACHE_TIME)
+        internal = __prepare_internal_images_for_maze(maze, size)
+        indexed = __prepare_indexed_images_for_maze(maze, size)
+
+        internal, indexed = yield internal, indexed
+        image_list = internal + indexed
+        cache.set(cache_key, image_list, time=config.MEMCACHE_TIME)
 
     raise ndb.Return(image_list)
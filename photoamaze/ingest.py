@@ -0,0 +1,179 @@
+"""
+    ingest
+    ======
+
+    Background ingestion of external images into the image index of each maze.
+    Viewers only ever read the index, so they never wait for Flickr or
+    Instagram.
+
+    :copyright: 2017 David Volquartz Lebech
+    :license: MIT, see LICENSE for details
+
+"""
+import datetime
+import logging
+import time
+
+import webapp2
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred, ndb
+
+from photoamaze import auth, config, imageutil, models
+
+# How often the last viewed time of a maze is updated.
+VIEWED_RESOLUTION = datetime.timedelta(hours=1)
+
+
+def enqueue_maze(maze_id, force=False):
+    """Enqueues ingestion of the given maze. Unless forced, the maze is
+    ingested at most once per ingestion interval.
+
+    """
+    name = None
+    if not force:
+        name = 'ingest-{}-{}'.format(
+            maze_id, int(time.time()) // config.INGEST_INTERVAL)
+    try:
+        deferred.defer(ingest_maze, maze_id, _name=name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def mark_viewed(maze):
+    """Marks the maze as viewed so it is picked up by the scheduled ingestion.
+    Mazes that have never been ingested are enqueued right away.
+
+    """
+    now = datetime.datetime.utcnow()
+    if not maze.last_viewed or now - maze.last_viewed > VIEWED_RESOLUTION:
+        models.Maze.touch(maze.key.id(), last_viewed=now)
+    if not maze.ingested:
+        enqueue_maze(maze.key.id())
+
+
+def ingest_maze(maze_id):
+    """Pulls the configured external sources of a maze into its image
+    index."""
+    maze = models.Maze.get_by_id(maze_id)
+    if not maze:
+        return
+
+    sources = imageutil.sources_for_maze(maze).get_result()
+    state_keys = [ndb.Key(models.MazeSourceState, name, parent=maze.key)
+                  for name in imageutil.SOURCES]
+    states = ndb.get_multi(state_keys)
+
+    # The image budget of a provider is shared by all its sources, in the
+    # order of imageutil.SOURCES.
+    budgets = {'flickr': config.Flickr.max_images,
+               'instagram': config.Instagram.max_images}
+
+    changed = False
+    for name, state_key, state in zip(imageutil.SOURCES, state_keys, states):
+        if name in sources:
+            provider = _provider(name)
+            limit = max(0, budgets[provider])
+            try:
+                source_changed, count = _ingest_source(
+                    maze, name, sources[name],
+                    state or models.MazeSourceState(key=state_key), limit)
+                changed |= source_changed
+                budgets[provider] -= count
+            except Exception as e:
+                if provider == 'flickr':
+                    auth.handle_flickr_error(maze, e)
+                else:
+                    # For now, just log everything.
+                    logging.exception(e)
+                # Images indexed by earlier runs still count.
+                budgets[provider] -= _count_source(maze, name, limit)
+        elif state:
+            # The source has been disabled.
+            _delete_source(maze, name)
+            state.key.delete()
+            changed = True
+
+    # The maze may have changed while the sources were ingested.
+    models.Maze.touch(maze_id, ingested=datetime.datetime.utcnow())
+    if changed:
+        maze.delete_cache()
+
+
+def _ingest_source(maze, name, source, state, limit):
+    """Ingests new images from a single source, keeping at most ``limit`` of
+    them. Returns whether the index was changed and the number of indexed
+    images of the source."""
+    settings = source[0]
+    changed = False
+    if state.settings != settings:
+        # The settings have changed so start over.
+        changed = _delete_source(maze, name)
+        state.settings = settings
+        state.cursor = None
+
+    # Newest items come first, so collecting stops at the newest item of the
+    # previous run. A source where nothing has changed costs a single page.
+    entries = imageutil.collect_source(source, limit, stop_at=state.cursor)
+    if entries:
+        # Entries come newest first.
+        run = int(time.time()) * 1000000
+        index_images = [
+            models.MazeIndexImage.from_local_images(maze.key, name, item_id,
+                                                    images, run - position)
+            for position, (item_id, images) in enumerate(entries)]
+        ndb.put_multi(index_images)
+        state.cursor = entries[0][0]
+        changed = True
+
+    # Trimming is also needed when earlier sources have used more of the
+    # budget than before.
+    trimmed, count = _trim_source(maze, name, limit)
+    state.put()
+    return changed or trimmed, count
+
+
+def _provider(name):
+    return 'flickr' if name.startswith('flickr') else 'instagram'
+
+
+def _count_source(maze, name, limit):
+    """Counts the indexed images of a source, up to the limit."""
+    return models.MazeIndexImage.query(
+        models.MazeIndexImage.source == name,
+        ancestor=maze.key).count(limit)
+
+
+def _delete_source(maze, name):
+    """Deletes all indexed images of a source. Returns whether anything was
+    deleted."""
+    keys = models.MazeIndexImage.query(
+        models.MazeIndexImage.source == name,
+        ancestor=maze.key).fetch(keys_only=True)
+    ndb.delete_multi(keys)
+    return bool(keys)
+
+
+def _trim_source(maze, name, limit):
+    """Deletes the oldest indexed images of a source above the limit. Returns
+    whether anything was deleted and the number of images left."""
+    images = models.MazeIndexImage.query(
+        models.MazeIndexImage.source == name,
+        ancestor=maze.key).fetch()
+    if len(images) <= limit:
+        return False, len(images)
+    images.sort(key=lambda img: img.order or 0, reverse=True)
+    ndb.delete_multi([img.key for img in images[limit:]])
+    return True, limit
+
+
+class IngestCronHandler(webapp2.RequestHandler):
+    """Enqueues ingestion of all recently viewed mazes."""
+    def get(self, *args, **kwargs):
+        cutoff = (datetime.datetime.utcnow() -
+                  datetime.timedelta(days=config.INGEST_ACTIVE_DAYS))
+        q = models.Maze.query(models.Maze.last_viewed >= cutoff)
+        count = 0
+        for maze_key in q.iter(keys_only=True):
+            enqueue_maze(maze_key.id())
+            count += 1
+        logging.info('Enqueued ingestion of {} mazes'.format(count))
@@ -9,21 +9,107 @@
 
 """
 import logging
+import time
+import urllib
 
 import webapp2
-from google.appengine.api import mail
+from google.appengine.api import mail, taskqueue
+from google.appengine.ext import deferred, ndb
 
-from photoamaze import config
+from photoamaze import config, imageutil, models
+
+INBOUND_QUEUE = 'inbound-mail'
 
 
 class MailHandler(webapp2.RequestHandler):
-    def post(self, *args, **kwargs):
-        msg = mail.InboundEmailMessage(self.request.body)
-        logging.info('Mail from: {}'.format(msg.sender))
-        logging.info('Subject: {}'.format(msg.subject))
-        for content_type, body in msg.bodies():
-            logging.info(content_type)
-            logging.info(body.decode())
+    """Receives photos mailed to ``<maze_id>@...``. The mail is only stored and
+    enqueued here, the photos are processed in batches by
+    :func:`process_inbound_mail`.
+
+    """
+    def post(self, address, *args, **kwargs):
+        maze_id = urllib.unquote(address).split('@')[0]
+        if len(self.request.body) > config.MAIL_MAX_SIZE:
+            logging.warning('Mail for {} is too large'.format(maze_id))
+            return
+
+        maze = models.Maze.get_by_id(maze_id) if maze_id else None
+        if not maze:
+            logging.info('Mail for unknown maze: {}'.format(maze_id))
+            return
+
+        mail_key = models.InboundMail.create(maze_id, self.request.body)
+        taskqueue.Queue(INBOUND_QUEUE).add(
+            taskqueue.Task(payload=mail_key.urlsafe(), method='PULL'))
+        enqueue_worker()
+
+
+def enqueue_worker():
+    """Enqueues a mail worker. Mails arriving within the same batch window are
+    handled by the same worker."""
+    window = int(time.time()) // config.MAIL_BATCH_WINDOW
+    try:
+        deferred.defer(process_inbound_mail,
+                       _name='inbound-mail-{}'.format(window),
+                       _countdown=config.MAIL_BATCH_WINDOW)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def process_inbound_mail():
+    """Processes a batch of inbound mails. Mails are processed one at a time,
+    so only a single mail is held in memory, and each mail and its task are
+    deleted as soon as it is done. The batch stops when MAIL_BATCH_BYTES of
+    mail have been processed and the rest is left for the next worker.
+
+    """
+    queue = taskqueue.Queue(INBOUND_QUEUE)
+    tasks = queue.lease_tasks(lease_seconds=300,
+                              max_tasks=config.MAIL_BATCH_SIZE)
+    if not tasks:
+        return
+
+    # Only the small mail entities are read here, the bodies are read per mail.
+    mails = ndb.get_multi([ndb.Key(urlsafe=task.payload) for task in tasks])
+
+    processed = 0
+    for i, (task, mail_entity) in enumerate(zip(tasks, mails)):
+        if mail_entity:
+            # Mails stored before the size was recorded may be of any size.
+            size = mail_entity.size or config.MAIL_MAX_SIZE
+            if processed and processed + size > config.MAIL_BATCH_BYTES:
+                # Hand the rest back to the queue right away.
+                for leftover in tasks[i:]:
+                    queue.modify_task_lease(leftover, 0)
+                break
+            processed += size
+            _process_mail(mail_entity)
+            mail_entity.delete_async().get_result()
+        queue.delete_tasks(task)
+    else:
+        if len(tasks) < config.MAIL_BATCH_SIZE:
+            return
+
+    # There might be more mails waiting.
+    deferred.defer(process_inbound_mail)
+
+
+def _process_mail(mail_entity):
+    """Stores the photos attached to a single inbound mail."""
+    try:
+        msg = mail.InboundEmailMessage(mail_entity.get_body_async().get_result())
+    except Exception as e:
+        logging.exception(e)
+        return
+    subject = getattr(msg, 'subject', '')
+    attachments = getattr(msg, 'attachments', [])
+    # A single attachment is not wrapped in a list.
+    if attachments and isinstance(attachments[0], basestring):
+        attachments = [attachments]
+    imageutil.store_images(ndb.Key(models.Maze, mail_entity.maze_id),
+                           ((subject, payload.decode())
+                            for filename, payload in attachments
+                            if imageutil.is_image_filename(filename)))
 
 
 def send_welcome(admin_email, maze_url, admin_url):
@@ -0,0 +1,195 @@
+"""
+    mazegen
+    =======
+
+    Seeded maze generation. Layouts are generated on the server, so everyone
+    viewing a maze walks the same maze, and are shared in a compact binary
+    format.
+
+    :copyright: 2017 David Volquartz Lebech
+    :license: MIT, see LICENSE for details
+
+"""
+import base64
+import hashlib
+import random
+import struct
+from collections import deque
+from itertools import izip
+
+from photoamaze.backends import cache
+from photoamaze.config import (MAZE_MIN_SIZE, MAZE_MAX_SIZE,
+                               MANIFEST_NEAR_DISTANCE)
+
+# Wall bits of a cell. A set bit means that the passage in that direction is
+# open. These match the directions used by static/js/src/maze.js.
+N, S, E, W = 1, 2, 4, 8
+
+# Layout header: rows and columns as unsigned big-endian shorts.
+HEADER = struct.Struct('>HH')
+
+LAYOUT_CACHE_KEY = 'mazelayout:{}:{}x{}'
+
+
+def maze_seed(maze_id):
+    """Returns the layout seed of a maze."""
+    return int(hashlib.sha1(str(maze_id)).hexdigest()[:8], 16)
+
+
+def clamp_size(size, default=10):
+    """Clamps a row or column count to the supported maze sizes."""
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        return default
+    return max(MAZE_MIN_SIZE, min(size, MAZE_MAX_SIZE))
+
+
+def generate(rows, cols, seed):
+    """Carves a maze with recursive backtracking, starting in the top-left
+    corner. An explicit stack is used instead of recursion, so large mazes do
+    not run into the recursion limit.
+
+    Returns a flat bytearray of rows * cols cells in row-major order.
+
+    """
+    rnd = random.Random(seed)
+    grid = bytearray(rows * cols)
+
+    # Direction -> (cell index offset, wall bit, opposite wall bit).
+    moves = [(N, -cols, N, S), (S, cols, S, N), (E, 1, E, W), (W, -1, W, E)]
+
+    visited = bytearray(rows * cols)
+    visited[0] = 1
+    stack = [0]
+    while stack:
+        cell = stack[-1]
+        row, col = divmod(cell, cols)
+
+        # Unvisited neighbours of the current cell.
+        options = []
+        for direction, offset, wall, opposite in moves:
+            if direction == N and row == 0:
+                continue
+            if direction == S and row == rows - 1:
+                continue
+            if direction == E and col == cols - 1:
+                continue
+            if direction == W and col == 0:
+                continue
+            if not visited[cell + offset]:
+                options.append((offset, wall, opposite))
+
+        if not options:
+            stack.pop()
+            continue
+
+        offset, wall, opposite = rnd.choice(options)
+        neighbour = cell + offset
+        grid[cell] |= wall
+        grid[neighbour] |= opposite
+        visited[neighbour] = 1
+        stack.append(neighbour)
+
+    return grid
+
+
+def pack(rows, cols, grid):
+    """Packs a grid into a header followed by two cells per byte, with the
+    first cell in the high nibble.
+
+    """
+    cells = grid if len(grid) % 2 == 0 else grid + bytearray(1)
+    packed = bytearray((a << 4) | b for a, b in izip(cells[0::2], cells[1::2]))
+    return HEADER.pack(rows, cols) + str(packed)
+
+
+def unpack(data):
+    """Unpacks a layout into (rows, cols, grid)."""
+    rows, cols = HEADER.unpack_from(data)
+    grid = bytearray()
+    for byte in bytearray(data[HEADER.size:]):
+        grid.append(byte >> 4)
+        grid.append(byte & 0xF)
+    return rows, cols, grid[:rows * cols]
+
+
+def get_layout(seed, rows, cols):
+    """Returns the packed layout for the given seed and size. Layouts never
+    change, so they are generated once and then shared through the cache.
+
+    """
+    key = LAYOUT_CACHE_KEY.format(seed, rows, cols)
+    layout = cache.get(key)
+    if layout is None:
+        layout = pack(rows, cols, generate(rows, cols, seed))
+        cache.set(key, layout)
+    return layout
+
+
+def distances(rows, cols, grid):
+    """Returns the walking distance, in cells, from the top-left corner to
+    every cell of a grid.
+
+    """
+    moves = ((N, -cols), (S, cols), (E, 1), (W, -1))
+    dist = [-1] * (rows * cols)
+    dist[0] = 0
+    queue = deque([0])
+    while queue:
+        cell = queue.popleft()
+        for wall, offset in moves:
+            neighbour = cell + offset
+            if grid[cell] & wall and dist[neighbour] < 0:
+                dist[neighbour] = dist[cell] + 1
+                queue.append(neighbour)
+    return dist
+
+
+def wall_slots(rows, cols, grid, dist=None):
+    """Returns the walls of a grid as (distance, row, col, direction) tuples,
+    ordered by walking distance from the top-left corner where the player
+    starts. Walls are placed like static/js/src/photomaze.js does: north and
+    west walls on the maze edge, south and east walls wherever the passage is
+    closed. Walls at the same distance keep that order.
+
+    """
+    if dist is None:
+        dist = distances(rows, cols, grid)
+    slots = []
+    for cell, walls in enumerate(grid):
+        row, col = divmod(cell, cols)
+        d = dist[cell]
+        if row == 0:
+            slots.append((d, row, col, N))
+        if col == 0:
+            slots.append((d, row, col, W))
+        if not walls & S:
+            slots.append((d, row, col, S))
+        if not walls & E:
+            slots.append((d, row, col, E))
+    slots.sort(key=lambda slot: slot[0])
+    return slots
+
+
+def image_manifest(images, layout):
+    """Returns the image manifest for image dicts and a packed layout.
+
+    Clients already have the layout, so the walls are not listed. Instead
+    ``dist`` has the walking distance of every cell, in row-major order, as
+    base64-encoded unsigned big-endian shorts, and clients order the walls
+    like :func:`wall_slots` does. Wall i gets image i modulo the number of
+    images, so the priority of an image is the distance to the first wall
+    showing it.
+
+    """
+    rows, cols, grid = unpack(layout)
+    dist = distances(rows, cols, grid)
+    slots = wall_slots(rows, cols, grid, dist)
+    for i, img in enumerate(images):
+        img['pri'] = slots[min(i, len(slots) - 1)][0]
+    return {
+        'images': images,
+        'dist': base64.b64encode(struct.pack('>{}H'.format(len(dist)), *dist)),
+        'near': MANIFEST_NEAR_DISTANCE
+    }
@@ -8,15 +8,27 @@
     :license: MIT, see LICENSE for details
 
 """
+import threading
+import time
+
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import ndb
-from google.appengine.api import memcache
 from webapp2_extras import security
 
-from photoamaze.config import PEPPER
+from photoamaze.backends import cache
+from photoamaze.config import PEPPER, MAZE_CACHE_TIME
 from photoamaze.util import html_escape, ReadOnly
 
+# In-process cache of serialized mazes, maze ID -> (expires, entity protobuf).
+_MAZE_CACHE = {}
+_MAZE_CACHE_LOCK = threading.Lock()
+_MAZE_CACHE_SIZE = 1000
+
 
 class LocalImage(object):
+    # Url of a low-resolution version of the image, if there is one.
+    low_url = ''
+
     def __init__(self, url, message, attribution='', external_url='',
                  license=''):
         self.url = url if isinstance(url, basestring) else str(url)
@@ -33,20 +45,53 @@ class LocalImage(object):
         return self.url == other.url and self.message == other.message
 
     def to_dict(self):
-        return {
+        d = {
             'url': self.url,
             'msg': self.message,
             'attrib': self.attribution,
             'eurl': self.external_url,
             'lic': self.license
         }
+        if self.low_url:
+            d['lurl'] = self.low_url
+        return d
 
 
 class MazeCacheKey(ReadOnly):
-    instagram_user = '{}:instagram_user'
-    flickr_user = '{}:flickr_user'
-    facebook_user = '{}:facebook_user'
+    """Maze-scoped cache keys. Use maze_cache_key to format them, so they
+    include the cache generation of the maze.
+
+    """
     image_list = '{}:imagelist'
+    rendered_image_list = '{}:imagelist:rendered'
+    rendered_manifest = '{}:manifest:rendered'
+    generation = '{}:generation'
+
+
+def cache_generation(maze_id):
+    """Returns the current cache generation of a maze."""
+    key = MazeCacheKey.generation.format(maze_id)
+    generation = cache.get(key)
+    if generation is None:
+        # Start from the current time so entries from an evicted generation
+        # are not used again.
+        cache.add(key, int(time.time()))
+        generation = cache.get(key)
+    return generation
+
+
+def maze_cache_key(maze_id, template):
+    """Formats a maze-scoped cache key for the current cache generation."""
+    return template.format('{}:{}'.format(maze_id, cache_generation(maze_id)))
+
+
+def delete_maze_cache(maze_id):
+    """Invalidates all maze-scoped cache entries of a maze by bumping its cache
+    generation. The old entries age out by themselves.
+
+    """
+    cache.incr(MazeCacheKey.generation.format(maze_id),
+               initial_value=int(time.time()))
 
 
 class BaseModel(ndb.Model):
@@ -54,12 +99,34 @@ class BaseModel(ndb.Model):
     modified = ndb.DateTimeProperty(auto_now=True, indexed=False)
 
 
+class UserAccessModel(ndb.Model):
+    """Base model for a user's access to some service. The user's profile is
+    cached for as long as the access stays the same.
+
+    """
+    @property
+    def profile_cache_key(self):
+        return profile_cache_key(self.key)
+
+    def _post_put_hook(self, future):
+        cache.delete(self.profile_cache_key)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        cache.delete(profile_cache_key(key))
+
+
+def profile_cache_key(user_access_key):
+    """Returns the profile cache key for the given user access key."""
+    return '{}:{}:profile'.format(user_access_key.kind(), user_access_key.id())
+
+
 class OAuthToken(BaseModel):
     """Represents an oauth token with a token key and secret."""
     secret = ndb.TextProperty()
 
 
-class FlickrUserAccess(ndb.Model):
+class FlickrUserAccess(UserAccessModel):
     """Represents a single user's access to Flickr. This is stored in a central
     location so it can be used in several different maze configurations.
 
@@ -82,7 +149,7 @@ class FlickrUserAccess(ndb.Model):
         return cls.get_by_id(user_id)
 
 
-class OAuthUserAccess(ndb.Model):
+class OAuthUserAccess(UserAccessModel):
     """Represents a single user's oauth access to some service."""
     access_token = ndb.TextProperty()
 
@@ -172,6 +239,48 @@ class Maze(BaseModel):
     # Whether or not to show share buttons on the photo maze.
     enable_sharing = ndb.BooleanProperty(default=False, indexed=False)
 
+    # When the maze was last viewed. Used for finding active mazes for the
+    # background ingestion.
+    last_viewed = ndb.DateTimeProperty()
+
+    # When the external images were last ingested into the image index.
+    ingested = ndb.DateTimeProperty(indexed=False)
+
+    # The snapshot the maze is frozen to, if any.
+    snapshot = ndb.KeyProperty(kind='MazeSnapshot', indexed=False)
+
+    @classmethod
+    def get_cached(cls, maze_id):
+        """Gets a maze through a short-lived in-process cache in front of ndb's
+        memcache. A fresh entity is returned every time, so changes to it do
+        not leak into other requests.
+
+        """
+        now = time.time()
+        cached = _MAZE_CACHE.get(maze_id)
+        if cached and cached[0] > now:
+            return cls._from_pb(entity_pb.EntityProto(cached[1]))
+
+        maze = cls.get_by_id(maze_id, use_memcache=True)
+        if maze:
+            with _MAZE_CACHE_LOCK:
+                if len(_MAZE_CACHE) >= _MAZE_CACHE_SIZE:
+                    for key, (expires, _) in _MAZE_CACHE.items():
+                        if expires <= now:
+                            del _MAZE_CACHE[key]
+                if len(_MAZE_CACHE) < _MAZE_CACHE_SIZE:
+                    _MAZE_CACHE[maze_id] = (now + MAZE_CACHE_TIME,
+                                            maze._to_pb().Encode())
+        return maze
+
+    def _post_put_hook(self, future):
+        # ndb takes care of memcache, only the in-process cache is left.
+        _MAZE_CACHE.pop(self.key.id(), None)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        _MAZE_CACHE.pop(key.id(), None)
+
     @property
     def name_encoded(self):
         if self.name:
@@ -220,12 +329,242 @@ class Maze(BaseModel):
         pwhash = '$'.join([self.password, self.hash_method, self.salt])
         return security.check_password_hash(password, pwhash, pepper=PEPPER)
 
+    @classmethod
+    @ndb.transactional
+    def touch(cls, maze_id, **values):
+        """Sets bookkeeping properties, like ``last_viewed``, on a fresh copy of
+        the maze. Copies read earlier may be stale, and putting them would undo
+        changes made since, like a new password or unlinked Flickr account.
+
+        """
+        maze = cls.get_by_id(maze_id)
+        if maze:
+            for name, value in values.items():
+                setattr(maze, name, value)
+            maze.put()
+
+    def cache_key(self, template):
+        return maze_cache_key(self.key.id(), template)
+
     def delete_cache(self):
-        for cache_key in MazeCacheKey.values:
-            memcache.delete(cache_key.format(self.key.id()))
+        delete_maze_cache(self.key.id())
+
+
+class ImageContent(BaseModel):
+    """Represents the contents of an uploaded image, shared by all MazeImages
+    with the same contents. The ID is the SHA-256 of the original upload and the
+    actual image data for each size is stored in ImageRendition children.
+
+    """
+    ref_count = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def add_references_async(cls, digest, count, renditions=None):
+        """Adds references to the content with the given digest. If the content
+        does not exist, it is created with the given renditions.
+
+        Returns False if the content does not exist and no renditions were
+        given.
+
+        """
+        content = yield cls.get_by_id_async(digest)
+        if not content:
+            if not renditions:
+                raise ndb.Return(False)
+            content = cls(id=digest)
+            yield ndb.put_multi_async(renditions)
+        content.ref_count += count
+        yield content.put_async()
+        raise ndb.Return(True)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def remove_references_async(cls, digest, count=1):
+        """Removes references to the content with the given digest. The content
+        and its renditions are deleted when there are no references left.
+
+        """
+        content = yield cls.get_by_id_async(digest)
+        if not content:
+            return
+        content.ref_count -= count
+        if content.ref_count > 0:
+            yield content.put_async()
+        else:
+            keys = yield ImageRendition.query(
+                ancestor=content.key).fetch_async(keys_only=True)
+            yield ndb.delete_multi_async([content.key] + keys)
+
+
+class ImageRendition(ndb.Model):
+    """Represents an image content in a specific size. The parent is the
+    ImageContent and the ID is the size.
+
+    """
+    image = ndb.BlobProperty(indexed=False)
 
 
 class MazeImage(BaseModel):
-    image_key = ndb.BlobKeyProperty(indexed=False)
+    """Represents an image in a maze. Only metadata is stored here, so listing
+    the images of a maze stays cheap. The image itself is an ImageContent.
+
+    """
+    content = ndb.KeyProperty(ImageContent, indexed=False)
+    message = ndb.TextProperty()
+
+    # Deprecated: Image bytes or blobstore blobs stored on the image itself.
+    # These are moved to ImageContent by imageutil.normalize_images.
     image = ndb.BlobProperty(indexed=False)
+    image_key = ndb.BlobKeyProperty(indexed=False)
+
+    # Dimensions of the blob in image_key and whether it is upright without
+    # applying its EXIF orientation. Recorded by imageutil.streamable_blob.
+    width = ndb.IntegerProperty(indexed=False)
+    height = ndb.IntegerProperty(indexed=False)
+    upright = ndb.BooleanProperty(indexed=False)
+
+
+class MazeSnapshot(BaseModel):
+    """Represents a frozen maze. The images of each texture size are fixed
+    when the maze is frozen, together with the size of the layout, and the
+    shared contents of the images are referenced so they stay around. A
+    snapshot never changes, so it can be cached for as long as it exists. The
+    parent is the maze.
+
+    """
+    # Rows and columns of the layout.
+    size = ndb.IntegerProperty(indexed=False)
+
+    # Texture size -> image dicts with snapshot texture urls.
+    images = ndb.JsonProperty(compressed=True)
+
+    # Deprecated: Flattened wall slots of the layout. The layout is generated
+    # again from the size instead.
+    walls = ndb.JsonProperty(compressed=True)
+
+    # Encoded image key -> caption to draw in, or None for plain images. Only
+    # these image keys are served for the snapshot.
+    image_keys = ndb.JsonProperty(compressed=True)
+
+    # Digests of the shared contents referenced by the snapshot.
+    contents = ndb.StringProperty(repeated=True, indexed=False)
+
+
+class InboundMail(BaseModel):
+    """Represents a raw inbound mail waiting to be processed. Mails with photos
+    easily exceed the entity size limit, so the contents are stored in
+    InboundMailChunk children.
+
+    """
+    maze_id = ndb.StringProperty(indexed=False)
+    chunk_count = ndb.IntegerProperty(indexed=False)
+    size = ndb.IntegerProperty(indexed=False)
+
+    @classmethod
+    def create(cls, maze_id, body, chunk_size=900000):
+        """Stores the given mail body for the maze and returns the key."""
+        key = ndb.Key(cls, cls.allocate_ids(size=1)[0])
+        chunks = [InboundMailChunk(id=i + 1, parent=key,
+                                   data=body[offset:offset + chunk_size])
+                  for i, offset in enumerate(xrange(0, len(body),
+                                                    chunk_size))]
+        mail = cls(key=key, maze_id=maze_id, chunk_count=len(chunks),
+                   size=len(body))
+        ndb.put_multi([mail] + chunks)
+        return key
+
+    def chunk_keys(self):
+        return [ndb.Key(InboundMailChunk, i + 1, parent=self.key)
+                for i in xrange(self.chunk_count or 0)]
+
+    @ndb.tasklet
+    def get_body_async(self):
+        chunks = yield ndb.get_multi_async(self.chunk_keys())
+        raise ndb.Return(''.join(chunk.data for chunk in chunks if chunk))
+
+    @ndb.tasklet
+    def delete_async(self):
+        yield ndb.delete_multi_async([self.key] + self.chunk_keys())
+
+
+class InboundMailChunk(ndb.Model):
+    """Part of the contents of an InboundMail."""
+    data = ndb.BlobProperty()
+
+
+class MazeUpload(BaseModel):
+    """Represents the progress of storing photos uploaded to a maze, so a
+    retried task continues where the last one left off. The parent is the maze
+    and the ID is the upload ID.
+
+    """
+    # Position of the next image to store, as the index of the uploaded blob
+    # and of the entry in a zip archive.
+    blob = ndb.IntegerProperty(default=0, indexed=False)
+    entry = ndb.IntegerProperty(default=0, indexed=False)
+
+    stored = ndb.IntegerProperty(default=0, indexed=False)
+    failed = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class MazeSourceState(BaseModel):
+    """Represents the ingestion state of a single external image source for a
+    maze. The parent is the maze and the ID is the source name.
+
+    """
+    # Identifies the source configuration. If the settings change, the indexed
+    # images for the source are thrown away.
+    settings = ndb.TextProperty()
+
+    # The provider ID of the newest item ingested.
+    cursor = ndb.TextProperty()
+
+
+class MazeIndexImage(BaseModel):
+    """Represents an external image in the image index of a maze. The parent is
+    the maze and the ID is the source name and provider ID.
+
+    """
+    source = ndb.StringProperty()
+
+    # Higher for newer items of the source: the ingestion run times a million
+    # minus the position of the item in the feed of that run.
+    order = ndb.IntegerProperty(indexed=False)
+
+    # Image keys for each of the indexed sizes.
+    urls = ndb.JsonProperty(indexed=False)
+
     message = ndb.TextProperty()
+    attribution = ndb.TextProperty()
+    external_url = ndb.TextProperty()
+    license = ndb.JsonProperty(indexed=False)
+
+    @classmethod
+    def from_local_images(cls, maze_key, source, item_id, images, order):
+        """Creates an index image from a dictionary of size to LocalImage."""
+        img = images[max(images)]
+        return cls(id=u'{}:{}'.format(source, item_id),
+                   parent=maze_key,
+                   source=source,
+                   order=order,
+                   urls=dict((str(size), i.url) for size, i in images.items()),
+                   message=img.message,
+                   attribution=img.attribution,
+                   external_url=img.external_url,
+                   license=img.license)
+
+    def to_local_image(self, size):
+        """Returns a LocalImage for the given size, falling back to the closest
+        size that is larger or, if none, the largest one available.
+
+        """
+        sizes = sorted(int(s) for s in self.urls or {})
+        if not sizes:
+            return None
+        larger = [s for s in sizes if s >= size]
+        url = self.urls[str(larger[0] if larger else sizes[-1])]
+        return LocalImage(url, self.message or '',
+                          attribution=self.attribution or '',
+                          external_url=self.external_url or '',
+                          license=self.license or '')
@@ -0,0 +1,188 @@
+"""
+    proxy
+    =====
+
+    Event-driven texture proxy for self-hosted deployments. It serves the
+    texture routes of the app from a single thread: external images are
+    fetched asynchronously, so thousands of fetches can be in flight without
+    a thread each, and uploaded images are loaded from a small thread pool.
+    Everything else is left to the WSGI app.
+
+    Needs `Tornado <http://www.tornadoweb.org>`_ and, on Python 2, the
+    ``futures`` backport. Run it next to the app, with the App Engine SDK on
+    the path like the tools do, and route the texture urls to it. Uploaded
+    images and mazes are read from the datastore of the app through
+    remote_api, so ``--app`` is the host of the app:
+
+        $ PHOTOAMAZE_BACKEND=local python2 -m photoamaze.proxy --port 8081 \
+              --app myapp.appspot.com
+
+    :copyright: 2017 David Volquartz Lebech
+    :license: MIT, see LICENSE for details
+
+"""
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen, httpclient, ioloop, web
+from webapp2_extras import securecookie
+
+from photoamaze import admission, config, imageutil, models
+from photoamaze.backends import cache
+from photoamaze.config import Proxy
+
+# Uploaded images are loaded through ndb, which blocks.
+_executor = ThreadPoolExecutor(Proxy.threads)
+
+# See the remote_api builtin in app_sample.yml.
+REMOTE_API_PATH = '/_ah/remote_api'
+
+
+class TextureHandler(web.RequestHandler):
+    @gen.coroutine
+    def serve(self, scope, image_key):
+        if imageutil.is_missing(image_key):
+            raise web.HTTPError(404)
+
+        ticket = admission.admit(scope, self.request.remote_ip)
+        if not ticket.admitted:
+            self.set_status(429)
+            self.set_header('Retry-After', str(ticket.retry_after))
+            return
+
+        with ticket:
+            try:
+                img_type, img_url_key, size = imageutil.decode_image_key(
+                    image_key)
+            except (TypeError, ValueError):
+                image = None
+            else:
+                cache_time = imageutil.external_cache_time(img_type)
+                if cache_time is not None:
+                    image = yield self.load_external(img_url_key, cache_time)
+                else:
+                    image = yield _executor.submit(
+                        imageutil.load_internal_image, img_type, img_url_key,
+                        size)
+
+        if not image:
+            imageutil.remember_missing(image_key)
+            raise web.HTTPError(404)
+        content, content_type = image
+        self.set_header('Content-Type', content_type)
+        self.set_header('Cache-Control', 'public, max-age=36000')
+        self.set_header('Pragma', 'Public')
+        self.write(content)
+
+    @gen.coroutine
+    def load_external(self, image_url_key, cache_time):
+        url = imageutil.external_url(image_url_key)
+        content = cache.get(url)
+        content_type = None
+
+        if content is None:
+            resp = yield httpclient.AsyncHTTPClient().fetch(
+                url, raise_error=False, request_timeout=Proxy.fetch_timeout)
+            if resp.code != 200 or not resp.body:
+                logging.warning('Could not fetch {}: {}'.format(url,
+                                                                resp.code))
+                raise gen.Return(None)
+            content = resp.body
+            content_type = resp.headers.get('Content-Type')
+            imageutil.cache_external(url, content, cache_time)
+
+        raise gen.Return(
+            (content, imageutil.external_content_type(url, content_type)))
+
+
+class PublicTextureHandler(TextureHandler):
+    """Serves /public/image/<image_id>."""
+    @gen.coroutine
+    def get(self, image_id):
+        if not imageutil.is_external(image_id):
+            raise web.HTTPError(404)
+        yield self.serve(admission.search_scope(self.get_argument('s', None)),
+                         image_id)
+
+
+class SignedTextureHandler(TextureHandler):
+    """Serves /maze/<maze_id>/t/<expires>/<signature>/<image_key>."""
+    @gen.coroutine
+    def get(self, maze_id, expires, signature, image_key):
+        if not imageutil.verify_texture(maze_id, image_key, expires,
+                                        signature):
+            raise web.HTTPError(403)
+        yield self.serve(maze_id, image_key)
+
+
+class MazeTextureHandler(TextureHandler):
+    """Serves /maze/<maze_id>/texture/<image_key>. Mazes with a password need
+    access in the session of the app, which is read from the session cookie
+    the same way webapp2 does.
+
+    """
+    @gen.coroutine
+    def get(self, maze_id, image_key):
+        maze = yield _executor.submit(models.Maze.get_cached, maze_id)
+        if not maze:
+            raise web.HTTPError(404)
+        if maze.password and not self.has_access(maze_id):
+            raise web.HTTPError(403)
+        yield self.serve(maze_id, image_key)
+
+    def has_access(self, maze_id):
+        settings = config.WEBAPP_CONFIG['webapp2_extras.sessions']
+        name = settings.get('cookie_name') or 'session'
+        value = self.get_cookie(name)
+        if not value:
+            return False
+        serializer = securecookie.SecureCookieSerializer(
+            settings['secret_key'])
+        session = serializer.deserialize(name, value) or {}
+        return bool((session.get(maze_id) or {}).get('has_access'))
+
+
+def make_app():
+    """Returns the proxy application with the texture routes of the app."""
+    httpclient.AsyncHTTPClient.configure(None, max_clients=Proxy.max_clients)
+    return web.Application([
+        (r'/public/image/(.+)', PublicTextureHandler),
+        (r'/maze/(\w+)/t/(\d+)/([^/]+)/([^/]+)', SignedTextureHandler),
+        (r'/maze/(\w+)/texture/([^/]+)', MazeTextureHandler),
+    ])
+
+
+def configure_remote_api(host):
+    """Sends the App Engine API calls of the proxy, like datastore lookups, to
+    the app at the given host through remote_api. Outside the app there is
+    nothing else to serve them.
+
+    """
+    from google.appengine.ext.remote_api import remote_api_stub
+    if host.split(':')[0] in ('localhost', '127.0.0.1'):
+        # The development server accepts any admin user.
+        remote_api_stub.ConfigureRemoteApi(
+            None, REMOTE_API_PATH, lambda: ('test@example.com', ''), host)
+    else:
+        remote_api_stub.ConfigureRemoteApiForOAuth(host, REMOTE_API_PATH)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Photo Amaze texture proxy')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--app', required=True,
+                        help='Host of the app, for example localhost:8080')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    configure_remote_api(args.app)
+    make_app().listen(args.port, address=args.address)
+    logging.info('Texture proxy listening on {}:{}'.format(args.address,
+                                                            args.port))
+    ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
@@ -48,11 +48,24 @@ routes = [
         PathPrefixRoute(r'/maze/<maze_id:\w+>', [
             webapp2.Route('/login', name='maze-login',
                           handler='MazeLoginHandler'),
+            webapp2.Route('/layout', name='maze-layout',
+                          handler='MazeLayoutHandler'),
             webapp2.Route('/texture/<image_key>', name='maze-texture',
                           handler='MazeTextureHandler'),
+            webapp2.Route('/t/<expires:\d+>/<signature>/<image_key>',
+                          name='maze-signed-texture',
+                          handler='MazeSignedTextureHandler'),
+            webapp2.Route('/s/<snapshot_id:\d+>/<image_key>',
+                          name='maze-snapshot-texture',
+                          handler='MazeSnapshotTextureHandler'),
+            webapp2.Route('/ct/<expires:\d+>/<signature>/<image_key>',
+                          name='maze-composite-texture',
+                          handler='MazeCompositeTextureHandler'),
             PathPrefixRoute('/image', [
                 webapp2.Route('/list', name='maze-image-list',
                               handler='MazeImageListHandler'),
+                webapp2.Route('/manifest', name='maze-image-manifest',
+                              handler='MazeImageManifestHandler'),
             ]),
             webapp2.Route('/admin/<admin_key>', name='maze-admin',
                           handler='MazeAdminHandler'),
@@ -67,6 +80,10 @@ routes = [
                               handler='MazeAdminFlickrHandler'),
                 webapp2.Route('/facebook', name='maze-admin-facebook',
                               handler='MazeAdminFacebookHandler'),
+                webapp2.Route('/upload', name='maze-admin-upload',
+                              handler='MazeAdminUploadHandler'),
+                webapp2.Route('/snapshot', name='maze-admin-snapshot',
+                              handler='MazeAdminSnapshotHandler'),
                 PathPrefixRoute('/connect', [
                     webapp2.Route('/instagram',
                                   name='maze-admin-connect-instagram',
@@ -82,6 +99,20 @@ routes = [
         ]),  # end maze path prefix
     ]),  # end hander prefix
 
+    # Warmup requests for new instances.
+    webapp2.Route('/_ah/warmup', name='warmup',
+                  handler='photoamaze.handlers.WarmupHandler'),
+
+    # Admin pages
+    webapp2.Route('/admin/admission', name='admin-admission',
+                  handler='photoamaze.admission.AdmissionMetricsHandler'),
+
+    # Scheduled tasks
+    webapp2.Route('/tasks/ingest', name='tasks-ingest',
+                  handler='photoamaze.ingest.IngestCronHandler'),
+    webapp2.Route('/tasks/migrate-images', name='tasks-migrate-images',
+                  handler='photoamaze.handlers.MigrateImagesTaskHandler'),
+
     # Incoming mail handler
     webapp2.Route('/_ah/mail/<address>', name='mail',
                   handler='photoamaze.mail.MailHandler')
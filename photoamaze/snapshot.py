@@ -0,0 +1,161 @@
+"""
+    snapshot
+    ========
+
+    Frozen mazes. Freezing a maze fixes its images and layout in a snapshot,
+    which is then served from a hot cache instead of the dynamic image list
+    path until the maze is unfrozen. Meant for mazes shown to many people at
+    once, like on a venue screen during an event.
+
+    :copyright: 2017 David Volquartz Lebech
+    :license: MIT, see LICENSE for details
+
+"""
+import base64
+import json
+import threading
+
+from google.appengine.ext import ndb
+
+from photoamaze import config, imageutil, mazegen, models, util
+from photoamaze.backends import cache
+
+# A viewport width for each texture size, see imageutil.normalize_size.
+VIEWPORT_WIDTHS = (0, 768, 992)
+
+# Snapshots never change, so they and their rendered bodies are kept
+# in-process. Snapshot key -> entity and (key, kind, size) -> variants.
+_SNAPSHOTS = {}
+_BODIES = {}
+_LOCK = threading.Lock()
+_CACHE_SIZE = 100
+
+
+def freeze(maze, size, uri_for):
+    """Freezes the maze to a new snapshot with a layout of the given size.
+    If the maze was already frozen, the old snapshot is replaced. ``uri_for``
+    is used to build the texture urls of the snapshot.
+
+    """
+    # Start from the current images, not the cached image lists.
+    maze.delete_cache()
+
+    snapshot_id = models.MazeSnapshot.allocate_ids(size=1, parent=maze.key)[0]
+    key = ndb.Key(models.MazeSnapshot, snapshot_id, parent=maze.key)
+
+    images = {}
+    image_keys = {}
+    contents = set()
+    for width in VIEWPORT_WIDTHS:
+        texture_size = imageutil.normalize_size(width)
+        local_images = imageutil.prepare_images_for_maze(
+            maze, size=width).get_result()
+        image_dicts = []
+        for img in local_images:
+            caption = img.message if config.COMPOSITE_TEXTURES else None
+            d = img.to_dict()
+            for field, url in (('url', img.url), ('lurl', img.low_url)):
+                if not url:
+                    continue
+                image_key = base64.urlsafe_b64encode(url)
+                image_keys[image_key] = caption
+                if url.startswith('c;'):
+                    contents.add(url.split(';')[1])
+                d[field] = uri_for('maze-snapshot-texture',
+                                   maze_id=maze.key.id(),
+                                   snapshot_id=snapshot_id,
+                                   image_key=image_key)
+            if config.COMPOSITE_TEXTURES:
+                d['comp'] = True
+            image_dicts.append(d)
+        images[str(texture_size)] = image_dicts
+
+    snapshot = models.MazeSnapshot(key=key, size=size, images=images,
+                                   image_keys=image_keys,
+                                   contents=sorted(contents))
+    snapshot.put()
+
+    # Pin the contents before the snapshot is used.
+    ndb.Future.wait_all([
+        models.ImageContent.add_references_async(digest, 1)
+        for digest in snapshot.contents])
+
+    old_key = maze.snapshot
+    maze.snapshot = key
+    maze.put()
+    if old_key:
+        release(old_key)
+    return snapshot
+
+
+def unfreeze(maze):
+    """Unfreezes the maze and releases its snapshot."""
+    old_key = maze.snapshot
+    if not old_key:
+        return
+    maze.snapshot = None
+    maze.put()
+    maze.delete_cache()
+    release(old_key)
+
+
+def release(key):
+    """Deletes a snapshot and releases its contents."""
+    snapshot = key.get()
+    key.delete()
+    with _LOCK:
+        _SNAPSHOTS.pop(key, None)
+    if snapshot:
+        ndb.Future.wait_all([
+            models.ImageContent.remove_references_async(digest)
+            for digest in snapshot.contents])
+
+
+def get_snapshot(key):
+    """Gets a snapshot, from the in-process cache when possible."""
+    snapshot = _SNAPSHOTS.get(key)
+    if snapshot is None:
+        snapshot = key.get()
+        if snapshot:
+            with _LOCK:
+                if len(_SNAPSHOTS) >= _CACHE_SIZE:
+                    _SNAPSHOTS.clear()
+                _SNAPSHOTS[key] = snapshot
+    return snapshot
+
+
+def get_variants(snapshot, kind, width):
+    """Returns the precompressed variants of the image list or the manifest
+    of a snapshot for a viewport width. ``kind`` is either 'list' or
+    'manifest'.
+
+    """
+    texture_size = str(imageutil.normalize_size(width))
+    body_key = (snapshot.key, kind, texture_size)
+    variants = _BODIES.get(body_key)
+    if variants is not None:
+        return variants
+
+    cache_key = 'snapshot:{}:{}:{}'.format(snapshot.key.urlsafe(), kind,
+                                           texture_size)
+    variants = cache.get(cache_key)
+    if variants is None:
+        images = [dict(img) for img in snapshot.images.get(texture_size, [])]
+        if kind == 'manifest':
+            # Layouts never change, so the one of the snapshot is generated
+            # again from its size.
+            layout = mazegen.get_layout(
+                mazegen.maze_seed(snapshot.key.parent().id()), snapshot.size,
+                snapshot.size)
+            body = mazegen.image_manifest(images, layout)
+        else:
+            body = images
+        variants = util.encode_variants(json.dumps(body),
+                                        config.COMPRESS_MIN_SIZE)
+        util.cache_variants(cache, cache_key, variants)
+
+    with _LOCK:
+        if len(_BODIES) >= _CACHE_SIZE:
+            _BODIES.clear()
+        _BODIES[body_key] = variants
+    return variants
@@ -8,9 +8,21 @@
     :license: MIT, see LICENSE for details
 
 """
+import importlib
 import json
+import logging
+import threading
+import zlib
 from xml.sax import saxutils
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Supported content encodings, in order of preference.
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
 
 class Bunch(object):
     def __init__(self, **kwds):
@@ -20,6 +32,55 @@ class Bunch(object):
         return json.dumps(self.__dict__)
 
 
+class ThreadResult(threading.Thread):
+    """Runs a function in a thread with an RPC-like get_result method."""
+    def __init__(self, func, *args, **kwargs):
+        super(ThreadResult, self).__init__()
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+
+    def get_result(self):
+        self.join()
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class LazyModule(object):
+    """A module that is imported on first use. ``setup`` is called with the
+    module right after it has been imported.
+
+    """
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    module = importlib.import_module(self._name)
+                    if self._setup:
+                        self._setup(module)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+
 class _ReadOnlyMetaClass(type):
     """A metaclass for creating read-only subclasses."""
     def __setattr__(self, name, value):
@@ -53,3 +114,61 @@ def html_escape(text):
 
 def html_status():
     return Bunch(error={}, success={}, info={})
+
+
+def compress(body, encoding):
+    """Compresses the body with the given content encoding."""
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    elif encoding == 'br':
+        return brotli.compress(body)
+    return body
+
+
+def encode_variants(body, min_size):
+    """Returns a dictionary of content encoding to body with a variant for all
+    supported encodings. Bodies smaller than ``min_size`` are not
+    compressed.
+
+    """
+    variants = {'identity': body}
+    if len(body) >= min_size:
+        for encoding in ENCODINGS:
+            variants[encoding] = compress(body, encoding)
+    return variants
+
+
+def cache_variants(cache, key, variants, time=0):
+    """Caches the variants from :func:`encode_variants`, unless they are too
+    large for the cache. Returns whether they were cached.
+
+    """
+    # Memcache values are limited to 1MB, including the pickling overhead.
+    if sum(len(body) for body in variants.values()) >= 900000:
+        return False
+    try:
+        cache.set(key, variants, time=time)
+    except Exception as e:
+        logging.exception(e)
+        return False
+    return True
+
+
+def accepted_encodings(header):
+    """Parses an Accept-Encoding header into a set of accepted encodings."""
+    accepted = set()
+    for part in (header or '').split(','):
+        params = part.strip().split(';')
+        encoding = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        if encoding and q > 0:
+            accepted.add(encoding)
+    return accepted
@@ -1,8 +1,18 @@
 /**
  * A 2D maze representation.
+ *
+ * If a layout is given, it should be the packed layout returned by the
+ * server: rows and columns as two big-endian shorts, followed by two cells
+ * per byte with the first cell in the high nibble.
  */
 class Maze {
-  constructor(rows, cols) {
+  constructor(rows, cols, layout) {
+    if (layout) {
+      const view = new DataView(layout);
+      rows = view.getUint16(0);
+      cols = view.getUint16(2);
+    }
+
     // Initialize an empty maze field.
     this.mazeGrid = [];
     for (let row = 0; row < rows; row += 1) {
@@ -46,26 +56,45 @@ class Maze {
       W: this.DIRECTIONS.E,
     };
 
-    // Setup the function that recursively carves the passages.
-    const carvePassage = (cx, cy, grid) => {
-      const rndDirs = ['N', 'S', 'E', 'W'].sort(() => Math.random() - 0.5);
-      for (let i = 0; i < rndDirs.length; i += 1) {
-        const direction = rndDirs[i];
-        const nx = cx + DX[direction];
-        const ny = cy + DY[direction];
+    // Use the layout from the server, so everyone sees the same maze.
+    if (layout) {
+      const cells = new Uint8Array(layout, 4);
+      for (let i = 0; i < rows * cols; i += 1) {
+        const byte = cells[i >> 1];
+        this.mazeGrid[Math.floor(i / cols)][i % cols] = (i % 2 === 0) ? byte >> 4 : byte & 0xF;
+      }
+      return;
+    }
+
+    // Carve the passages with an explicit stack, so large mazes do not
+    // overflow the call stack.
+    const carvePassages = (grid) => {
+      // Start at position 0, 0.
+      const stack = [[0, 0]];
+      while (stack.length > 0) {
+        const [cx, cy] = stack[stack.length - 1];
+        const options = Object.keys(DX).filter((direction) => {
+          const nx = cx + DX[direction];
+          const ny = cy + DY[direction];
+          return ny >= 0 && ny <= grid.length - 1 && nx >= 0 &&
+            nx <= grid[ny].length - 1 && grid[ny][nx] === 0;
+        });
 
-        if (ny >= 0 && ny <= grid.length - 1 && nx >= 0 &&
-            nx <= grid[ny].length - 1 && grid[ny][nx] === 0) {
+        if (options.length === 0) {
+          stack.pop();
+        } else {
+          const direction = options[Math.floor(Math.random() * options.length)];
+          const nx = cx + DX[direction];
+          const ny = cy + DY[direction];
           grid[cy][cx] |= this.DIRECTIONS[direction];
           grid[ny][nx] |= OPPOSITE[direction];
-          carvePassage(nx, ny, grid);
+          stack.push([nx, ny]);
         }
       }
     };
 
     // Carve out the passages
-    // Start at position 0, 0.
-    carvePassage(0, 0, this.mazeGrid);
+    carvePassages(this.mazeGrid);
 
     console.log(this.printMaze());
   }
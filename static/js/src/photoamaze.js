@@ -3,8 +3,8 @@ const PhotoMaze = require('./photomaze');
 // Initially empty image list.
 let images = [];
 
-// Loads images from the given url.
-const loadImages = (url, obj) => {
+// Loads JSON from the given url and query parameters.
+const loadJSON = (url, obj, callback) => {
   const req = new XMLHttpRequest();
   let qs = '';
   Object.keys(obj).forEach((k) => {
@@ -16,14 +16,29 @@ const loadImages = (url, obj) => {
   req.open('GET', url, true);
   req.onload = function () {
     if (this.status >= 200 && this.status < 400) {
-      const data = JSON.parse(this.response);
-      images = data;
-      PhotoMaze.loadImages(data);
+      callback(JSON.parse(this.response));
     }
   };
   req.send();
 };
 
+// Loads images from the given url.
+const loadImages = (url, obj) => {
+  loadJSON(url, obj, (data) => {
+    images = data;
+    PhotoMaze.loadImages(data);
+  });
+};
+
+// Loads an image manifest from the given url. The walls closest to the
+// player are textured first.
+const loadManifest = (url, obj) => {
+  loadJSON(url, obj, (data) => {
+    images = data.images;
+    PhotoMaze.loadManifest(data);
+  });
+};
+
 // Fills the attribution list.
 const fillAttribList = () => {
   const copy = document.getElementById('copyright-list');
@@ -68,12 +83,36 @@ const overlay = (controls, sharing, copyright) => {
   document.getElementById('overlay').style.display = '';
 };
 
-document.addEventListener('DOMContentLoaded', () => {
-  // Start the maze with a 10 by 10 grid.
-  PhotoMaze.start('render-area', 10, 10);
+// Loads the maze layout from the given url. The callback gets null if the
+// layout could not be loaded.
+const loadLayout = (url, callback) => {
+  const req = new XMLHttpRequest();
+  req.open('GET', url, true);
+  req.responseType = 'arraybuffer';
+  req.onload = function () {
+    if (this.status >= 200 && this.status < 400) callback(this.response);
+    else callback(null);
+  };
+  req.onerror = () => callback(null);
+  req.send();
+};
 
-  // Load image textures
-  loadImages(window.imagesUrl, window.imagesParams);
+// Starts the maze and loads the image textures.
+const startMaze = (layout) => {
+  // Without a layout, start the maze with a 10 by 10 grid.
+  PhotoMaze.start('render-area', 10, 10, layout);
+
+  // Load image textures. The manifest only matches the server layout.
+  if (layout && window.manifestUrl && PhotoMaze.isWebGL()) {
+    loadManifest(window.manifestUrl, window.manifestParams);
+  } else {
+    loadImages(window.imagesUrl, window.imagesParams);
+  }
+};
+
+document.addEventListener('DOMContentLoaded', () => {
+  if (window.layoutUrl) loadLayout(window.layoutUrl, startMaze);
+  else startMaze(null);
 
   // Add WebGL warning, if necessary.
   if (!PhotoMaze.isWebGL()) {
@@ -69,10 +69,18 @@ let curCol = 0;
 // Whether or not the current maze is enabled.
 let enabled = false;
 
+// Walls showing a low-resolution image until the player gets within
+// upgradeDistance cells, keyed by row and column. See PhotoMaze.loadManifest.
+let upgrades = new Map();
+let upgradeDistance = 0;
+
 let usingWebGL = true;
 
-// Image loader and loading texture placeholder.
+// Image loader and loading texture placeholder. Images are fetched with the
+// file loader first, so the response status and headers can be read.
 const imgLoader = new THREE.ImageLoader();
+const fileLoader = new THREE.FileLoader();
+fileLoader.setResponseType('blob');
 const textureLoader = new THREE.TextureLoader();
 const wallTexture = textureLoader.load('/img/wall.jpg');
 wallTexture.minFilter = THREE.LinearFilter;
@@ -126,6 +134,7 @@ const createWall = (x, z, direction) => {
   const materials = [material1, material2];
 
   const wall = new THREE.Mesh(wallGeometry, new THREE.MultiMaterial(materials));
+  wall.userData.direction = direction;
 
   switch (direction) {
     case maze.DIRECTIONS.N:
@@ -269,6 +278,143 @@ const getObstacles = () => {
   return obstacles;
 };
 
+/**
+ * Loads an image. When the server is too busy to serve it right away, the
+ * request is retried after the time given in its Retry-After header.
+ */
+const loadImage = (url, onLoad, onError, retries = 5) => {
+  fileLoader.load(url, (blob) => {
+    const objectUrl = URL.createObjectURL(blob);
+    imgLoader.load(objectUrl, (img) => {
+      URL.revokeObjectURL(objectUrl);
+      onLoad(img);
+    }, undefined, (event) => {
+      URL.revokeObjectURL(objectUrl);
+      onError(event);
+    });
+  }, undefined, (event) => {
+    const request = event.target;
+    if (request.status === 429 && retries > 0) {
+      const retryAfter = parseInt(request.getResponseHeader('Retry-After'), 10) || 1;
+      // Spread the retries, so the walls do not all come back at once.
+      const delay = (retryAfter + Math.random()) * 1000;
+      setTimeout(() => loadImage(url, onLoad, onError, retries - 1), delay);
+    } else {
+      onError(event);
+    }
+  });
+};
+
+/**
+ * Asynchronously load an image and add it to the given wall.
+ * It is assumed that image is a JS object with a 'url' attribute.
+ * The optional onDone is called when the image has loaded or failed. When
+ * upgrading, the current texture is kept until the new image has loaded.
+ */
+const addImageToWall = (image, mesh, onDone, upgrade) => {
+  // The last image added to a wall is shown, whichever loads first.
+  mesh.userData.url = image.url;
+
+  // Add loading wall
+  if (!upgrade) {
+    mesh.material.materials[0].map = loadingTexture;
+    mesh.material.materials[1].map = loadingTexture;
+  }
+
+  // Start loading the image.
+  loadImage(image.url, (img) => {
+    // Composited images are already square power-of-two textures with the
+    // message drawn in, so they can be used directly.
+    if (image.comp && !(image.texture instanceof THREE.Texture)) {
+      image.texture = new THREE.Texture(img);
+      image.texture.needsUpdate = true;
+    }
+
+    // Check to see if the image already has a texture set. This could
+    // have hapened in a different context and there is no need to draw
+    // it again.
+    if (!(image.texture instanceof THREE.Texture)) {
+      // The size of the texture is the longest side of the image.
+      const size = Math.max(img.width, img.height);
+
+      // Create canvas
+      const canvas = document.createElement('canvas');
+      canvas.width = size;
+      canvas.height = size;
+
+      // Get context
+      const context = canvas.getContext('2d');
+
+      // Draw wall background
+      context.fillStyle = 'black';
+      context.fillRect(0, 0, size, size);
+
+      const offsetX = (size - img.width) / 2;
+      const offsetY = (size - img.height) / 2;
+
+      // Draw image. Offset based on the shortest side.
+      context.drawImage(img, offsetX, offsetY);
+
+      if (image.msg.length > 0) {
+        // Maximum width with 5% padding if needed.
+        const maxWidth = size - (size * 0.05);
+
+        // Setup font and fill style.
+        context.save();
+        context.fillStyle = 'white';
+        context.strokeStyle = 'black';
+        context.textAlign = 'center';
+        context.textBaseline = 'middle';
+        context.lineWidth = 2;
+
+        if (img.width < img.height) {
+          context.font = `${offsetX / 2}px sans-serif`;
+          context.translate(0, size);
+          context.rotate(-Math.PI / 2);
+          context.fillText(image.msg, size / 2, offsetX / 2, maxWidth);
+        } else {
+          context.font = `${offsetY / 2}px sans-serif`;
+          context.fillText(image.msg, size / 2, size - (offsetY / 2), maxWidth);
+        }
+        context.restore();
+      }
+
+      // Create the texture.
+      image.texture = new THREE.Texture(canvas);
+      image.texture.minFilter = THREE.LinearFilter;
+      image.texture.needsUpdate = true;
+    }
+
+    // Update the wall on both sides.
+    if (mesh.userData.url === image.url) {
+      mesh.material.materials[0].map = image.texture;
+      mesh.material.materials[1].map = image.texture;
+    }
+    if (onDone) onDone();
+  }, () => {
+    if (onDone) onDone();
+  });
+};
+
+/**
+ * Loads the full-resolution images of the walls near the player that still
+ * show a low-resolution image.
+ */
+const upgradeNearWalls = () => {
+  if (upgrades.size === 0) return;
+
+  for (let row = curRow - upgradeDistance; row <= curRow + upgradeDistance; row += 1) {
+    for (let col = curCol - upgradeDistance; col <= curCol + upgradeDistance; col += 1) {
+      const key = `${row},${col}`;
+      const cellUpgrades = upgrades.get(key);
+      if (cellUpgrades) {
+        upgrades.delete(key);
+        cellUpgrades.forEach(({ image, wall }) => addImageToWall(image, wall, null, true));
+      }
+    }
+  }
+};
+
 const updateMaze = (elapsed) => {
   if (enabled) {
     // Update the player view.
@@ -276,8 +422,13 @@ const updateMaze = (elapsed) => {
 
     // Save the current row/col position.
     const curPos = player.getPosition();
-    curRow = Math.round(curPos.z / wallWidth);
-    curCol = Math.round(curPos.x / wallWidth);
+    const row = Math.round(curPos.z / wallWidth);
+    const col = Math.round(curPos.x / wallWidth);
+    if (row !== curRow || col !== curCol) {
+      curRow = row;
+      curCol = col;
+      upgradeNearWalls();
+    }
 
     // Update minimap.
     if (minimap !== null) {
@@ -346,8 +497,8 @@ const initScene = (renderAreaId) => {
   window.addEventListener('resize', handleResize);
 };
 
-const initMaze = (length, width) => {
-  maze = new Maze(length, width);
+const initMaze = (length, width, layout) => {
+  maze = new Maze(length, width, layout);
   init3DMaze();
   minimap = new MiniMap(maze);
   document.body.appendChild(minimap.domElement);
@@ -370,78 +521,6 @@ const animate = () => {
   if (stats) stats.update();
 };
 
-/**
- * Asynchronously load an image and add it to the given wall.
- * It is assumed that image is a JS object with a 'url' attribute.
- */
-const addImageToWall = (image, mesh) => {
-  // Add loading wall
-  mesh.material.materials[0].map = loadingTexture;
-  mesh.material.materials[1].map = loadingTexture;
-
-  // Start loading the image.
-  imgLoader.load(image.url, (img) => {
-    // Check to see if the image already has a texture set. This could
-    // have hapened in a different context and there is no need to draw
-    // it again.
-    if (!(image.texture instanceof THREE.Texture)) {
-      // The size of the texture is the longest side of the image.
-      const size = Math.max(img.width, img.height);
-
-      // Create canvas
-      const canvas = document.createElement('canvas');
-      canvas.width = size;
-      canvas.height = size;
-
-      // Get context
-      const context = canvas.getContext('2d');
-
-      // Draw wall background
-      context.fillStyle = 'black';
-      context.fillRect(0, 0, size, size);
-
-      const offsetX = (size - img.width) / 2;
-      const offsetY = (size - img.height) / 2;
-
-      // Draw image. Offset based on the shortest side.
-      context.drawImage(img, offsetX, offsetY);
-
-      if (image.msg.length > 0) {
-        // Maximum width with 5% padding if needed.
-        const maxWidth = size - (size * 0.05);
-
-        // Setup font and fill style.
-        context.save();
-        context.fillStyle = 'white';
-        context.strokeStyle = 'black';
-        context.textAlign = 'center';
-        context.textBaseline = 'middle';
-        context.lineWidth = 2;
-
-        if (img.width < img.height) {
-          context.font = `${offsetX / 2}px sans-serif`;
-          context.translate(0, size);
-          context.rotate(-Math.PI / 2);
-          context.fillText(image.msg, size / 2, offsetX / 2, maxWidth);
-        } else {
-          context.font = `${offsetY / 2}px sans-serif`;
-          context.fillText(image.msg, size / 2, size - (offsetY / 2), maxWidth);
-        }
-        context.restore();
-      }
-
-      // Create the texture.
-      image.texture = new THREE.Texture(canvas);
-      image.texture.minFilter = THREE.LinearFilter;
-      image.texture.needsUpdate = true;
-    }
-
-    // Update the wall on both sides.
-    mesh.material.materials[0].map = image.texture;
-    mesh.material.materials[1].map = image.texture;
-  });
-};
-
 class PhotoMaze {
   /**
    * Loads the given images onto the walls of the maze.
@@ -449,6 +528,7 @@ class PhotoMaze {
    */
   static loadImages(images) {
     if (images.length === 0 || walls === null) return;
+    upgrades = new Map();
 
     for (let i = 0; i < walls.length; i += 1) {
       for (let j = 0; j < walls[i].length; j += 1) {
@@ -463,6 +543,76 @@ class PhotoMaze {
     }
   }
 
+  /**
+   * Loads the images of a manifest onto the walls of the maze. The manifest
+   * has the walking distance of every cell from the start, as base64-encoded
+   * unsigned big-endian shorts in row-major order, and the walls are loaded
+   * ordered by the distance of their cell. Wall i gets image i modulo the
+   * number of images. Walls within the near distance are loaded first and the rest
+   * once those have loaded. The further walls get the low-resolution version
+   * of the image, if there is one, until the player gets close.
+   */
+  static loadManifest(manifest) {
+    const images = manifest.images;
+    if (images.length === 0 || walls === null) return;
+
+    upgrades = new Map();
+    upgradeDistance = manifest.near;
+
+    const lowImages = [];
+    const farWalls = [];
+    let pending = 0;
+
+    const loadFarWalls = () => {
+      farWalls.forEach(({ image, wall, key }) => {
+        // Skip walls that were upgraded while waiting.
+        if (key && !upgrades.has(key)) return;
+        addImageToWall(image, wall);
+      });
+    };
+
+    const nearWallDone = () => {
+      pending -= 1;
+      if (pending === 0) loadFarWalls();
+    };
+
+    // Order the walls like the server does, keeping the order of the walls
+    // at the same distance.
+    const dist = atob(manifest.dist);
+    const ordered = [];
+    for (let row = 0; row < walls.length; row += 1) {
+      for (let col = 0; col < walls[row].length; col += 1) {
+        const cell = (row * walls[row].length) + col;
+        const distance = (dist.charCodeAt(cell * 2) * 256) + dist.charCodeAt((cell * 2) + 1);
+        walls[row][col].forEach((wall) => {
+          ordered.push({ row, col, wall, distance, order: ordered.length });
+        });
+      }
+    }
+    ordered.sort((a, b) => (a.distance - b.distance) || (a.order - b.order));
+
+    ordered.forEach(({ row, col, wall, distance }, i) => {
+      const index = i % images.length;
+      const image = images[index];
+      if (distance <= manifest.near) {
+        pending += 1;
+        addImageToWall(image, wall, nearWallDone);
+      } else if (image.lurl) {
+        if (!lowImages[index]) {
+          lowImages[index] = { url: image.lurl, msg: image.msg, comp: image.comp };
+        }
+        const key = `${row},${col}`;
+        if (!upgrades.has(key)) upgrades.set(key, []);
+        upgrades.get(key).push({ image, wall });
+        farWalls.push({ image: lowImages[index], wall, key });
+      } else {
+        farWalls.push({ image, wall });
+      }
+    });
+
+    if (pending === 0) loadFarWalls();
+  }
+
   /**
    * Return a boolean indicating whether the WebGL renderer is used or not.
    */
@@ -515,9 +665,10 @@ class PhotoMaze {
   }
 
   /**
-   * Start sets up the maze and begins rendering.
+   * Start sets up the maze and begins rendering. The optional layout is a
+   * packed maze layout from the server.
    */
-  static start(renderAreaId, length, width) {
+  static start(renderAreaId, length, width, layout) {
     // Determine whether or not to use webgl.
     usingWebGL = Detector.webgl;
 
@@ -528,7 +679,7 @@ class PhotoMaze {
 
     // Create the maze.
     // Webgl, ok for any length/width (almost)
-    if (usingWebGL) initMaze(length, width);
+    if (usingWebGL) initMaze(length, width, layout);
     // Not WebGL, limit to 4 by 4.
     else initMaze(4, 4);
 
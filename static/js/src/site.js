@@ -15,6 +15,32 @@
     });
   };
 
+  const plural = (count) => `${count} photo${count !== 1 ? 's' : ''}`;
+
+  // Follows the progress of an upload, which is stored in the background.
+  const pollUploadProgress = () => {
+    const $progress = $('#upload-progress');
+    if (!$progress.length) return;
+
+    const poll = () => {
+      $.getJSON($progress.data('progress-url'))
+        .done((progress) => {
+          if (progress.done === undefined) {
+            $progress.text('The progress of the upload is no longer known.');
+            return;
+          }
+          let text = `${plural(progress.stored)} uploaded`;
+          if (progress.failed) {
+            text += `, ${plural(progress.failed)} could not be uploaded`;
+          }
+          $progress.text(progress.done ? text : `${text}...`);
+          if (!progress.done) setTimeout(poll, 2000);
+        })
+        .fail(() => setTimeout(poll, 5000));
+    };
+    poll();
+  };
+
   $(document).ready(() => {
     // Set the form status.
     setFormStatus();
@@ -24,5 +50,7 @@
 
     // Set button toggles.
     setupForm();
+
+    pollUploadProgress();
   });
 })(window.jQuery);
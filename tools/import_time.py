@@ -0,0 +1,77 @@
+#!/usr/bin/env python2
+"""
+    import_time
+    ===========
+
+    Measures how long it takes to import Photo Amaze and the provider SDKs in a
+    fresh interpreter, which is most of the cold start cost of a new instance.
+    Results can be appended to a CSV file to track the cost over time.
+
+        $ python2 tools/import_time.py --sdk path/to/google_appengine \\
+            --output import_times.csv
+
+    :copyright: 2017 David Volquartz Lebech
+    :license: MIT, see LICENSE for details
+
+"""
+import argparse
+import csv
+import datetime
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODULES = ['photoamaze', 'photoamaze.handlers', 'flickr_api', 'instagram']
+
+CHILD = """
+import os, sys, time
+sys.path.insert(0, {sdk!r})
+import dev_appserver
+dev_appserver.fix_sys_path()
+sys.path[:0] = [{root!r}, os.path.join({root!r}, 'lib')]
+os.environ.setdefault('SERVER_SOFTWARE', 'Development/2.0')
+start = time.time()
+import {module}
+sys.stdout.write(repr(time.time() - start))
+"""
+
+
+def measure(sdk, module):
+    code = CHILD.format(sdk=sdk, root=ROOT, module=module)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return float(output.strip().splitlines()[-1]) * 1000
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=ROOT).strip()
+    except Exception:
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='Path to the App Engine SDK (google_appengine)')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='CSV file to append results to')
+    args = parser.parse_args()
+
+    rows = []
+    now = datetime.datetime.utcnow().isoformat()
+    rev = revision()
+    for module in MODULES:
+        times = sorted(measure(args.sdk, module) for _ in range(args.runs))
+        median = times[len(times) // 2]
+        print('{:<24} {:8.1f} ms'.format(module, median))
+        rows.append([now, rev, module, '{:.1f}'.format(median)])
+
+    if args.output:
+        with open(args.output, 'ab') as f:
+            csv.writer(f).writerows(rows)
+
+
+if __name__ == '__main__':
+    main()